@@ -8,28 +8,103 @@ When the playlist is empty, random tracks are played, with a selection biased
 towards lesser-played tracks.
 
 Position display inside tracks and seeking is currently not possible.
+
+On Unix-like systems, SIGHUP re-reads the configuration file, and SIGUSR2
+restarts the program (e.g. after an upgrade) without interrupting the track
+that is currently playing.
 """
 __version__ = "1.0.6"
 __author__ = "Martin Fiedler <keyj@emphy.de>"
 
-import sys, os, re, argparse, random, collections, math
-import time, threading, subprocess, socket
+import sys, os, re, argparse, random, collections, math, itertools
+import time, threading, subprocess, socket, select, errno, tempfile, shutil, signal
 import BaseHTTPServer, SocketServer
-import zlib
+import zlib, bisect, json, Queue, urllib, urlparse, hashlib, unicodedata
+import traceback, cProfile, pstats, marshal, cStringIO
 try:
     import _winreg
 except ImportError:
     _winreg = None
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+try:
+    import ctypes
+except ImportError:
+    ctypes = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
 
 DefaultPort = 8088
-AcceptedExts = "mp4 m4v mov mkv webm mpg ts mts m2ts m2t ogv avi wmv asf".split() \
-             + "mp3 ogg oga m4a mka wma wav aif aiff flac".split()
+VideoExts = "mp4 m4v mov mkv webm mpg ts mts m2ts m2t ogv avi wmv asf".split()
+AudioExts = "mp3 ogg oga m4a mka wma wav aif aiff flac".split()
+AcceptedExts = VideoExts + AudioExts
 PollInterval = 0.2
 MinAcceptedPlayTime = 3.0
 MaxUnsuccessfulPlays = 5
 MinPlayTime = 120
 DefaultStateFile = ".kjukebox_state"
 DefaultHistoryDepth = 250
+DefaultScanThreads = 0
+DefaultLookahead = 1
+DefaultFolderSpread = 2
+BatchOps = "add insert remove move playnow".split()
+MaxBatchSize = 1024 * 1024
+DefaultRateLimit = (5.0, 10)
+DefaultCoalesceWindow = 0.3
+ListenerTimeout = 60  # seconds since a web client's last request
+TranscodeProbeCmd = "ffprobe -v error -select_streams V:0 -show_entries stream=codec_name,width,height,avg_frame_rate -of default=noprint_wrappers=1 $"
+DefaultTranscodeCmd = "ffmpeg -y -v error -i $ -map 0:V:0 -map 0:a:0? -c:v libx264 -profile:v high -preset veryfast -crf 21 " \
+                    + "-vf scale='min(1920,iw)':'min(1080,ih)':force_original_aspect_ratio=decrease:force_divisible_by=2,fps='min(30,source_fps)' " \
+                    + "-c:a aac -b:a 192k -movflags +faststart -f mp4 @"
+TranscodeProfile = {"codec": "h264", "width": 1920, "height": 1088, "fps": 30.5}
+DefaultTranscodeCacheSize = 4096  # MiB
+DefaultTranscodeJobs = 1
+ThumbnailSeekCmd = "ffmpeg -y -v error -ss 15 -i $ -map 0:v:0 -frames:v 1 -vf scale=160:-2 -f image2 -c:v mjpeg @"
+ThumbnailCmd = "ffmpeg -y -v error -i $ -map 0:v:0 -frames:v 1 -vf scale=160:-2 -f image2 -c:v mjpeg @"
+DefaultThumbnailCacheSize = 256  # MiB
+CacheTouchInterval = 86400  # seconds between updates of a cache file's mtime
+CacheEvictTarget = 0.9  # fraction of the maximum size to evict down to
+ThumbnailMaxAge = 7 * 24 * 3600
+LoudnessCmd = "ffmpeg -nostats -hide_banner -i $ -map 0:a:0 -af loudnorm=print_format=json -f null -"
+DefaultLoudnessTarget = -23.0  # LUFS
+MaxLoudnessGain = 15.0  # dB
+DefaultLoudnessJobs = 1
+DedupeSamples = 8
+DedupeSampleSize = 64 * 1024
+DefaultDedupeJobs = 2
+PlaceholderGIF = "GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\x00\x00\x00!\xf9\x04\x01\x00\x00\x00\x00,\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;"
+LogLevels = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+LogQueueSize = 10000
+LogBatchSize = 256
+DatabaseBatchSize = 1000
+DefaultStatsCount = 20
+MaxStatsCount = 1000
+SendChunkSize = 65536
+DefaultProfileTime = 10.0
+MaxProfileTime = 300.0
+ProfileSampleInterval = 0.005
+DefaultLogMaxSize = 10 * 1024 * 1024
+DefaultLogBackups = 3
+PlaylistFormats = {"m3u": "audio/x-mpegurl", "m3u8": "audio/x-mpegurl", "pls": "audio/x-scpls"}
+ExportChunkSize = 256  # entries
+HandoverEnv = "KJUKEBOX_HANDOVER"
+HandoverFormat = 1
+MetricsBuckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
 
 ################################################################################
 
@@ -64,18 +139,156 @@ def nulldev():
         g_nulldev = open(("nul" if (sys.platform == "win32") else "/dev/null"), "wb")
     return g_nulldev
 
-logfile = None
-logmtx = threading.Lock()
-def log(msg=None, to_stderr=False):
+class RotatingFile(object):
+    def __init__(self, filename, max_size=DefaultLogMaxSize, backups=DefaultLogBackups):
+        self.filename = filename
+        self.max_size = max_size
+        self.backups = backups
+        self.mutex = threading.Lock()
+        self.f = open(filename, "a")
+        self.size = self.f.tell()
+
+    @staticmethod
+    def _move(src, dest):
+        if (sys.platform == "win32") and os.path.exists(dest):
+            os.unlink(dest)  # rename() doesn't replace files on Windows
+        os.rename(src, dest)
+
+    def _rotate(self):
+        self.f.close()
+        try:
+            for i in xrange(self.backups - 1, 0, -1):
+                src = "%s.%d" % (self.filename, i)
+                if os.path.exists(src):
+                    self._move(src, "%s.%d" % (self.filename, i + 1))
+            if self.backups > 0:
+                self._move(self.filename, self.filename + ".1")
+        finally:
+            # if anything failed, just keep appending to the current file
+            # and try again after another max_size bytes
+            self.f = open(self.filename, "a")
+            self.size = 0
+
+    def write(self, data):
+        with self.mutex:
+            if self.f.closed:  # reopening after a failed rotation failed
+                self.f = open(self.filename, "a")
+                self.size = self.f.tell()
+            if self.max_size and self.size and ((self.size + len(data)) > self.max_size):
+                try:
+                    self._rotate()
+                except EnvironmentError, e:
+                    log("WARNING: failed to rotate %s - %s" % (self.filename, e), True)
+            self.f.write(data)
+            self.f.flush()
+            self.size += len(data)
+
+    def close(self):
+        with self.mutex:
+            self.f.close()
+
+class Logger(object):
+    sink = None
+    level = LogLevels["info"]
+    access_rate = 1.0
+    json = False
+    queue = Queue.Queue(LogQueueSize)
+    thread = None
+
+    @classmethod
+    def open(self, filename, max_size=DefaultLogMaxSize, backups=DefaultLogBackups):
+        self.sink = RotatingFile(filename, max_size, backups)
+        self.thread = threading.Thread(target=self._writer, name="Logger")
+        self.thread.daemon = True
+        self.thread.start()
+
+    @classmethod
+    def close(self):
+        if not self.thread:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        self.sink.close()
+        self.sink = None
+
+    @classmethod
+    def enqueue(self, entry):
+        try:
+            self.queue.put_nowait(entry)
+        except Queue.Full:
+            Metrics.inc("kjukebox_log_dropped_total")
+
+    @classmethod
+    def _format(self, entry):
+        if entry[1] == "raw":
+            return entry[2] + "\n"
+        t, level, msg = entry
+        stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t))
+        if self.json:
+            return json.dumps({"time": stamp, "ts": round(t, 3), "level": level, "msg": msg}) + "\n"
+        return "[%s] %s\n" % (stamp, msg)
+
+    @classmethod
+    def _writer(self):
+        while True:
+            batch = [self.queue.get()]
+            while (len(batch) < LogBatchSize) and not(batch[-1] is None):
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            done = batch[-1] is None
+            data = ''.join(self._format(e) for e in batch if e)
+            if data:
+                try:
+                    self.sink.write(data)
+                except EnvironmentError, e:
+                    print >>sys.stderr, "WARNING: failed to write log file -", e
+                    StatusScreen.shown = None
+            if done:
+                return
+
+def log_level_of(msg):
+    if msg.startswith(("ERROR", "FATAL", "INTERNAL ERROR")):
+        return "error"
+    if msg.startswith("WARNING"):
+        return "warning"
+    return "info"
+
+def log(msg=None, to_stderr=False, level=None):
     if not msg:
         return
     if to_stderr:
         print >>sys.stderr, msg
-    if not logfile:
+        StatusScreen.shown = None  # repaint the whole screen next time
+    if not Logger.sink:
+        return
+    level = level or log_level_of(msg)
+    if LogLevels[level] < Logger.level:
         return
-    with logmtx:
-        logfile.write("[%s] %s\n" % (time.strftime("%Y-%m-%d %H:%M:%S"), msg))
-        logfile.flush()
+    if isinstance(msg, unicode):
+        msg = msg.encode('utf-8')
+    Logger.enqueue((time.time(), level, msg))
+
+def log_raw(line):
+    # unformatted line for separators and the like; never written as JSON
+    if Logger.sink and not(Logger.json):
+        Logger.enqueue((None, "raw", line))
+
+def log_access(msg):
+    if Logger.access_rate <= 0.0:
+        log(msg, level="debug")
+    elif (Logger.access_rate >= 1.0) or (random.random() < Logger.access_rate):
+        log(msg, level="info")
+
+def player_output_pump(pipe, sink):
+    for line in iter(pipe.readline, ''):
+        try:
+            sink.write(line)
+        except EnvironmentError:
+            pass
+    pipe.close()
 
 def find_binary(name):
     if os.access(name, os.X_OK):
@@ -116,6 +329,341 @@ def get_console_size():
         pass
     return (80, 24)  # default fallback
 
+def list_dir(path):
+    # split a directory into subdirectories (to descend into) and files,
+    # using the same rules as os.walk (symlinked dirs are neither)
+    dirs, files = [], []
+    if scandir:
+        for e in scandir(path):
+            if not e.is_dir():
+                files.append(e.name)
+            elif not e.is_symlink():
+                dirs.append(e.name)
+    else:
+        for name in os.listdir(path):
+            full = os.path.join(path, name)
+            if not os.path.isdir(full):
+                files.append(name)
+            elif not os.path.islink(full):
+                dirs.append(name)
+    return dirs, files
+
+def walk_sequential(root):
+    for base, dirs, files in os.walk(root):
+        assert base.startswith(root)
+        yield base[len(root):].lstrip('\\/'), files
+
+def walk_parallel(root, threads):
+    # walk the tree with a pool of threads, each listing one directory at a
+    # time; this hides the per-directory round trip of network filesystems
+    pending = Queue.Queue()
+    results = []
+    def worker():
+        while True:
+            rel = pending.get()
+            if rel is None:
+                return
+            try:
+                dirs, files = list_dir(os.path.join(root, rel) if rel else root)
+                results.append((rel, files))
+                for d in dirs:
+                    pending.put(os.path.join(rel, d))
+            except EnvironmentError:
+                pass
+            finally:
+                pending.task_done()
+    pool = [threading.Thread(target=worker, name="Scanner-%d" % i) for i in xrange(threads)]
+    for t in pool:
+        t.daemon = True
+        t.start()
+    pending.put('')
+    pending.join()
+    for t in pool:
+        pending.put(None)
+    for t in pool:
+        t.join()
+    results.sort()
+    return results
+
+def find_file_by_key(root, key):
+    # relative path of the media file with the given key, found by listing
+    # only the directories along the way, or None
+    rel = ''
+    parts = key.split('/')
+    for i, part in enumerate(parts):
+        try:
+            dirs, files = list_dir(os.path.join(root, rel) if rel else root)
+        except EnvironmentError:
+            return None
+        if i < (len(parts) - 1):
+            names = [d for d in dirs if MediaFile.make_key(d) == part]
+        else:
+            names = [f for f in files if MediaFile.is_accepted(f) and (MediaFile.make_path_key(f) == part)]
+        if not names:
+            return None
+        rel = os.path.join(rel, min(names))
+    return rel
+
+def pick_random_file(root, max_dirs=32):
+    # relative path of some media file, found by descending into random
+    # subdirectories; cheap even for huge libraries, but may give up
+    rel = ''
+    for i in xrange(max_dirs):
+        try:
+            dirs, files = list_dir(os.path.join(root, rel) if rel else root)
+        except EnvironmentError:
+            dirs, files = [], []
+        entries = [(f, False) for f in files if MediaFile.is_accepted(f)] + [(d, True) for d in dirs if not d.startswith('.')]
+        if not entries:
+            if not rel:
+                return None
+            rel = ''  # dead end, start over
+            continue
+        name, is_dir = random.choice(entries)
+        rel = os.path.join(rel, name)
+        if not is_dir:
+            return rel
+    return None
+
+################################################################################
+
+MetricsInfo = {
+    "kjukebox_transition_gap_seconds":       ("histogram", "time between player exit and next player spawn"),
+    "kjukebox_player_spawn_seconds":         ("histogram", "time needed to spawn the player executable"),
+    "kjukebox_player_starts_total":          ("counter",   "number of player executable starts"),
+    "kjukebox_player_failures_total":        ("counter",   "number of suspiciously short player runs"),
+    "kjukebox_mutex_wait_seconds":           ("histogram", "time spent waiting for a lock"),
+    "kjukebox_mutex_hold_seconds":           ("histogram", "time a lock has been held"),
+    "kjukebox_engine_queue_seconds":         ("histogram", "time commands wait in the engine queue"),
+    "kjukebox_rescan_seconds":               ("histogram", "duration of library rescans"),
+    "kjukebox_rescan_new_files_total":       ("counter",   "number of new files found by rescans"),
+    "kjukebox_rescan_deleted_files_total":   ("counter",   "number of deleted files detected by rescans"),
+    "kjukebox_library_files":                ("gauge",     "number of files in the library"),
+    "kjukebox_state_save_seconds":           ("histogram", "duration of state file saves"),
+    "kjukebox_http_request_seconds":         ("histogram", "HTTP request latency by endpoint"),
+    "kjukebox_http_ratelimited_total":       ("counter",   "number of web commands rejected by the rate limiter"),
+    "kjukebox_skips_coalesced_total":        ("counter",   "number of skip commands merged into an earlier one"),
+    "kjukebox_transcode_seconds":            ("histogram", "duration of background transcodes"),
+    "kjukebox_transcode_failures_total":     ("counter",   "number of failed transcodes"),
+    "kjukebox_cache_evictions_total":        ("counter",   "number of files evicted from a cache directory"),
+    "kjukebox_loudness_seconds":             ("histogram", "duration of background loudness measurements"),
+    "kjukebox_loudness_failures_total":      ("counter",   "number of files whose loudness could not be measured"),
+    "kjukebox_dedupe_files_hashed_total":    ("counter",   "number of files fingerprinted for duplicate detection"),
+    "kjukebox_duplicate_groups":             ("gauge",     "number of sets of identical files in the library"),
+    "kjukebox_log_dropped_total":            ("counter",   "number of log messages dropped due to a full queue"),
+}
+
+class Histogram(object):
+    def __init__(self, buckets=MetricsBuckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def copy(self):
+        h = Histogram(self.buckets)
+        h.counts = list(self.counts)
+        h.count = self.count
+        h.sum = self.sum
+        return h
+
+class Metrics(object):
+    mutex = threading.Lock()
+    values = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted(labels.iteritems())))
+
+    @classmethod
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.mutex:
+            self.values[key] = self.values.get(key, 0) + value
+
+    @classmethod
+    def set(self, name, value, **labels):
+        with self.mutex:
+            self.values[self._key(name, labels)] = value
+
+    @classmethod
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.mutex:
+            try:
+                self.values[key].observe(value)
+            except KeyError:
+                h = self.values[key] = Histogram()
+                h.observe(value)
+
+    @staticmethod
+    def _fmt_labels(labels, extra=None):
+        labels = list(labels)
+        if extra:
+            labels.append(extra)
+        if not labels:
+            return ""
+        return "{%s}" % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels)
+
+    @classmethod
+    def render(self):
+        with self.mutex:
+            items = sorted((k, (v.copy() if isinstance(v, Histogram) else v)) for k, v in self.values.iteritems())
+        lines = []
+        last_name = None
+        for (name, labels), value in items:
+            if name != last_name:
+                mtype, mhelp = MetricsInfo.get(name, ("untyped", name))
+                lines.append("# HELP %s %s" % (name, mhelp))
+                lines.append("# TYPE %s %s" % (name, mtype))
+                last_name = name
+            if not isinstance(value, Histogram):
+                lines.append("%s%s %r" % (name, self._fmt_labels(labels), value))
+                continue
+            h = value
+            total = 0
+            for le, n in zip(h.buckets + ("+Inf",), h.counts):
+                total += n
+                lines.append("%s_bucket%s %d" % (name, self._fmt_labels(labels, ("le", le)), total))
+            lines.append("%s_sum%s %r" % (name, self._fmt_labels(labels), h.sum))
+            lines.append("%s_count%s %d" % (name, self._fmt_labels(labels), h.count))
+        return '\n'.join(lines) + '\n'
+
+class TimedLock(object):
+    # drop-in replacement for threading.Lock that records wait and hold times
+    # and the name of the thread holding it
+    instances = []
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.acquired_at = None
+        self.owner = None
+        TimedLock.instances.append(self)
+
+    def __enter__(self):
+        t0 = time.time()
+        self.lock.acquire()
+        self.acquired_at = t1 = time.time()
+        self.owner = threading.current_thread().name
+        Metrics.observe("kjukebox_mutex_wait_seconds", t1 - t0, lock=self.name)
+        return self
+
+    def __exit__(self, *exc):
+        held = time.time() - self.acquired_at
+        self.acquired_at = None
+        self.owner = None
+        self.lock.release()
+        Metrics.observe("kjukebox_mutex_hold_seconds", held, lock=self.name)
+
+################################################################################
+
+class Debug(object):
+    # opt-in diagnostics for the web interface: thread stacks, lock owners
+    # and two kinds of profilers
+    enabled = False
+    allowed = set()
+    mutex = threading.Lock()
+    busy = False
+    profiles = None  # list of cProfile.Profile objects while profiling
+
+    @classmethod
+    def allow(self, ip):
+        return self.enabled and (is_local_ip(ip) or (ip in self.allowed))
+
+    @staticmethod
+    def thread_names():
+        return dict((t.ident, t.name) for t in threading.enumerate())
+
+    @classmethod
+    def thread_stacks(self):
+        names = self.thread_names()
+        lines = []
+        for ident, frame in sorted(sys._current_frames().iteritems()):
+            lines.append("Thread %s (%d):" % (names.get(ident, "?"), ident))
+            lines.extend(line.rstrip('\n') for line in traceback.format_stack(frame))
+            lines.append("")
+        return lines
+
+    @classmethod
+    def lock_status(self):
+        now = time.time()
+        lines = []
+        for lock in TimedLock.instances:
+            since, owner = lock.acquired_at, lock.owner
+            if since is None:
+                lines.append("%s\tfree" % lock.name)
+            else:
+                lines.append("%s\theld by %s for %.3f seconds" % (lock.name, owner, now - since))
+        return lines
+
+    @classmethod
+    def _start(self):
+        with self.mutex:
+            if self.busy:
+                return False
+            self.busy = True
+            return True
+
+    @classmethod
+    def sample(self, seconds):
+        # statistical profile of all threads, in the "collapsed stacks"
+        # format understood by flame graph tools; None if already running
+        if not self._start():
+            return None
+        try:
+            counts = collections.Counter()
+            me = threading.current_thread().ident
+            end = time.time() + seconds
+            while time.time() < end:
+                names = self.thread_names()
+                for ident, frame in sys._current_frames().iteritems():
+                    if ident == me:
+                        continue
+                    stack = []
+                    while frame:
+                        code = frame.f_code
+                        stack.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                        frame = frame.f_back
+                    thread = re.sub(r'-\d+$', '', names.get(ident, "?"))
+                    counts[';'.join([thread] + stack[::-1])] += 1
+                time.sleep(ProfileSampleInterval)
+            return ["%s %d" % item for item in sorted(counts.iteritems())]
+        finally:
+            self.busy = False
+
+    @classmethod
+    def profile(self, seconds):
+        # deterministic profile of everything that runs through run()
+        # during the next few seconds; None if already running
+        if not self._start():
+            return None
+        try:
+            self.profiles = []
+            time.sleep(seconds)
+            with self.mutex:
+                profiles, self.profiles = self.profiles, None
+            return profiles
+        finally:
+            self.busy = False
+
+    @classmethod
+    def run(self, func, *args):
+        if self.profiles is None:
+            return func(*args)
+        prof = cProfile.Profile()
+        try:
+            return prof.runcall(func, *args)
+        finally:
+            with self.mutex:
+                if not(self.profiles is None):
+                    self.profiles.append(prof)
+
 ################################################################################
 
 Players = map(str.strip, """
@@ -128,6 +676,22 @@ Players = map(str.strip, """
     mplayer -fs? $
 """.strip().split('\n'))
 
+# how to tell each player to apply a gain; dB = decibels, mB = millibels,
+# linear = amplitude factor
+PlayerGainArgs = {
+    "omxplayer.bin": "--vol {mB}",
+    "omxplayer":     "--vol {mB}",
+    "mpv":           "--af-add=lavfi=[volume={dB}dB]",
+    "vlc":           "--gain={linear}",
+    "mplayer":       "-af-add volume={dB}",
+}
+
+def player_gain_args(cmdline, gain):
+    base = os.path.splitext(os.path.basename(cmdline[0]))[0].lower()
+    if not(base in PlayerGainArgs) or not(gain):
+        return []
+    return PlayerGainArgs[base].format(dB="%.1f" % gain, mB=int(round(gain * 100)), linear="%.3f" % (10.0 ** (gain / 20.0))).split()
+
 def setup_player(name=None, fullscreen=True):
     if name:
         full = find_binary(name)
@@ -167,6 +731,8 @@ StatusFont = dict(zip((
        j     j       j       j       j       j       j       j       j       j   j   j               #             j
 '''.replace('\r', '').strip('\n')).replace('#', unichr(0x2592)).split('\n')))))
 StatusFontHeight = len(StatusFont.values()[0])
+# glyph names by their first character, longest first
+StatusFontIndex = dict((c, sorted((g for g in StatusFont if g[0] == c), key=len, reverse=True)) for c in set(g[0] for g in StatusFont))
 
 class Distributor(object):
     def __init__(self, n):
@@ -177,24 +743,37 @@ class Distributor(object):
         return p
 
 class StatusScreen(object):
+    # the screen is kept as a list of lines; after the first full repaint,
+    # only lines that have changed are rewritten
+    mutex = threading.Lock()
+    live = False   # show a live status line at the bottom
+    shown = None   # lines currently on the screen
+    frame = None   # lines of the last update(), without the live line
+    frame_key = None
+    covered = False  # a player has been running since the last redraw
+
     @classmethod
     def init(self, text=None, logofile=None):
         w, h = get_console_size()
-        self.width = w - 1
-        self.height = h - 1
+        with self.mutex:
+            self.width = w - 1
+            self.height = h - 1
+            self.encoding = sys.stdout.encoding or 'utf-8'
 
-        if logofile:
-            self.inter_lines = self._load_file(logofile)
-        elif text:
-            self.inter_lines = self._render_text(text)
-        else:
-            self.inter_lines = ""
+            if logofile:
+                inter_lines = self._load_file(logofile)
+            elif text:
+                inter_lines = self._render_text(text)
+            else:
+                inter_lines = ""
 
-        # distribute extra lines
-        d = Distributor(max(self.height - 6 - self.inter_lines.count('\n'), 0))
-        self.inter_lines = (d.get(4) * "\n") + self.inter_lines + (d.get(3) * "\n")
-        self.pre_gap = d.get(2) * "\n"
-        self.post_gap = d.get() * "\n"
+            # distribute extra lines
+            d = Distributor(max(self.height - 6 - inter_lines.count('\n'), 0))
+            inter_lines = (d.get(4) * "\n") + inter_lines + (d.get(3) * "\n")
+            self.pre_gap = (d.get(2) * "\n").split('\n')[:-1]
+            self.inter_lines = inter_lines.encode(self.encoding, 'replace').split('\n')[:-1]
+            self.post_gap = (d.get() * "\n").split('\n')
+            self.shown = self.frame = self.frame_key = None
 
     @classmethod
     def _load_file(self, filename):
@@ -223,13 +802,15 @@ class StatusScreen(object):
         for part in text.split('\0'):
             rows = [""] * StatusFontHeight
             while part:
-                try:
-                    l, g = max((len(g), g) for g in StatusFont if part.startswith(g))
-                    part = part[l:]
-                    for i, x in enumerate(StatusFont[g]):
-                        rows[i] += x
-                except ValueError:
-                    part = part[1:]
+                for g in StatusFontIndex.get(part[0], ()):
+                    if part.startswith(g):
+                        break
+                else:
+                    part = part[1:]  # no glyph for this character
+                    continue
+                part = part[len(g):]
+                for i, x in enumerate(StatusFont[g]):
+                    rows[i] += x
             parts.append(rows)
 
         # join parts if they fit into a line
@@ -254,42 +835,258 @@ class StatusScreen(object):
     @classmethod
     def substatus(self, caption, fill, f):
         if not f:
-            return sys.stdout.write("\n\n\n")
-        name = f.label.replace(u'\xa0', ' ').replace(u'\u25ba', '>').replace(u'\u2014', '--').encode(sys.stdout.encoding, 'replace')
+            return ["", "", ""]
+        name = f.label.replace(u'\xa0', ' ').replace(u'\u25ba', '>').replace(u'\u2014', '--').encode(self.encoding, 'replace')
         if len(name) > self.width:
             name = "..." + name[3-self.width:]
         else:
             name = (((self.width - len(name)) / 2) * " ") + name
-        sys.stdout.write("%s\n%s\n%s\n" % (caption.center(self.width, fill), name, self.width * fill))
+        return [caption.center(self.width, fill), name, self.width * fill]
+
+    @classmethod
+    def live_line(self):
+        n = WebRequestHandler.active_clients()
+        return ("%s  |  %d listener%s" % (time.strftime("%H:%M:%S"), n, "" if (n == 1) else "s")).center(self.width).rstrip()
 
     @classmethod
     def update(self, prev=None, next=None):
+        with self.mutex:
+            if self.covered:
+                self.covered = False
+                self.shown = None  # the player may have drawn over it
+            if (prev, next) != self.frame_key:
+                self.frame_key = (prev, next)
+                self.frame = self.pre_gap + self.substatus(" PREVIOUSLY ", '-', prev) + self.inter_lines \
+                           + self.substatus(" UP NOW ", '=', next) + self.post_gap
+            self._draw()
+
+    @classmethod
+    def tick(self):
+        # called regularly; redraws the live status line when it changes,
+        # and the whole screen once a player has stopped, but doesn't draw
+        # anything underneath a running player
+        if ListManager.player:
+            self.covered = True
+        elif self.frame and (sys.platform != "win32") and (self.live or self.covered):
+            with self.mutex:
+                if self.covered:
+                    self.covered = False
+                    self.shown = None
+                self._draw()
+
+    @classmethod
+    def _draw(self):
+        lines = self.frame
+        if self.live:
+            lines = lines[:-1] + [self.live_line()]
         if sys.platform == "win32":
-            sys.stdout.write((self.height + 1) * '\n')
+            sys.stdout.write((self.height + 1) * '\n' + '\n'.join(lines))
+        elif not(self.shown) or (len(self.shown) != len(lines)):
+            sys.stdout.write("\x1b[2J\x1b[H" + '\n'.join(lines))
         else:
-            sys.stdout.write("\x1b[2J\x1b[H")
-        sys.stdout.write(self.pre_gap)
-        self.substatus(" PREVIOUSLY ", '-', prev)
-        sys.stdout.write(self.inter_lines)
-        self.substatus(" UP NOW ", '=', next)
-        sys.stdout.write(self.post_gap)
+            for row, (old, new) in enumerate(zip(self.shown, lines)):
+                if new != old:
+                    sys.stdout.write("\x1b[%d;1H%s\x1b[K" % (row + 1, new))
+        self.shown = lines
         sys.stdout.flush()
 
 ################################################################################
 
+class IndexedListNode(object):
+    __slots__ = ("item", "prio", "size", "left", "right", "parent")
+    def __init__(self, item):
+        self.item = item
+        self.prio = random.random()
+        self.size = 1
+        self.left = self.right = self.parent = None
+
+class IndexedList(object):
+    # list-like sequence with O(log n) insertion, deletion and lookup by
+    # position, and O(log n) position lookup by item (implicit treap)
+    def __init__(self, items=()):
+        self.root = None
+        self.nodes = {}
+        self.splice(0, items)
+
+    @staticmethod
+    def _size(t):
+        return t.size if t else 0
+
+    @classmethod
+    def _update(self, t):
+        t.size = 1 + self._size(t.left) + self._size(t.right)
+        if t.left:  t.left.parent = t
+        if t.right: t.right.parent = t
+
+    @classmethod
+    def _merge(self, a, b):
+        if not a: return b
+        if not b: return a
+        if a.prio > b.prio:
+            a.right = self._merge(a.right, b)
+            self._update(a)
+            return a
+        b.left = self._merge(a, b.left)
+        self._update(b)
+        return b
+
+    @classmethod
+    def _split(self, t, k):
+        # split into the first k items and the rest
+        if not t:
+            return None, None
+        if self._size(t.left) >= k:
+            l, r = self._split(t.left, k)
+            t.left = r
+            self._update(t)
+            return l, t
+        l, r = self._split(t.right, k - self._size(t.left) - 1)
+        t.right = l
+        self._update(t)
+        return t, r
+
+    def _set_root(self, t):
+        if t: t.parent = None
+        self.root = t
+
+    def _rank(self, node):
+        r = self._size(node.left)
+        while node.parent:
+            if node is node.parent.right:
+                r += self._size(node.parent.left) + 1
+            node = node.parent
+        return r
+
+    def _node_at(self, pos):
+        t = self.root
+        while t:
+            n = self._size(t.left)
+            if pos < n:
+                t = t.left
+            elif pos == n:
+                return t
+            else:
+                pos -= n + 1
+                t = t.right
+
+    def _norm(self, pos, clamp=True):
+        n = self._size(self.root)
+        if pos < 0:
+            pos += n
+        if clamp:
+            return min(max(pos, 0), n)
+        if not(0 <= pos < n):
+            raise IndexError("IndexedList index out of range")
+        return pos
+
+    def __len__(self):
+        return self._size(self.root)
+
+    def __iter__(self):
+        stack = []
+        t = self.root
+        while stack or t:
+            while t:
+                stack.append(t)
+                t = t.left
+            t = stack.pop()
+            yield t.item
+            t = t.right
+
+    def __contains__(self, item):
+        return item in self.nodes
+
+    def __repr__(self):
+        return "IndexedList(%r)" % list(self)
+
+    def __getitem__(self, pos):
+        if isinstance(pos, slice):
+            return list(self)[pos]
+        return self._node_at(self._norm(pos, False)).item
+
+    def __delitem__(self, pos):
+        if isinstance(pos, slice):
+            if not(pos.step in (None, 1)):
+                raise ValueError("IndexedList does not support extended slices")
+            a = self._norm(pos.start or 0)
+            b = self._norm(len(self) if (pos.stop is None) else pos.stop)
+        else:
+            a = self._norm(pos, False)
+            b = a + 1
+        if a >= b:
+            return
+        l, r = self._split(self.root, a)
+        m, r = self._split(r, b - a)
+        self._set_root(self._merge(l, r))
+        stack = [m]
+        while stack:
+            t = stack.pop()
+            if t:
+                nodes = self.nodes[t.item]
+                nodes.remove(t)
+                if not nodes:
+                    del self.nodes[t.item]
+                stack.extend((t.left, t.right))
+
+    def splice(self, pos, items):
+        m = None
+        for item in items:
+            node = IndexedListNode(item)
+            self.nodes.setdefault(item, []).append(node)
+            m = self._merge(m, node)
+        if m:
+            l, r = self._split(self.root, self._norm(pos))
+            self._set_root(self._merge(self._merge(l, m), r))
+
+    def insert(self, pos, item):
+        self.splice(pos, (item,))
+
+    def append(self, item):
+        self.splice(len(self), (item,))
+
+    def index(self, item):
+        try:
+            return min(self._rank(node) for node in self.nodes[item])
+        except KeyError:
+            raise ValueError("item is not in IndexedList")
+
+    def remove(self, item):
+        del self[self.index(item)]
+
+    def pop(self, pos=-1):
+        pos = self._norm(pos, False)
+        item = self._node_at(pos).item
+        del self[pos]
+        return item
+
+    def move(self, item, pos):
+        try:
+            self.remove(item)
+        except ValueError:
+            return False
+        self.insert(pos, item)
+        return True
+
+################################################################################
+
 class MediaFile(object):
+    iid_counter = itertools.count(1)
+    label_sep = u'\xa0\u25ba '
+
     def __init__(self, path, key=None):
+        self.iid = next(self.iid_counter)
         self.path = path
         self.key = key or self.make_key(path)
+        self.folder = self.key.split('/', 1)[0] if ('/' in self.key) else ''
         self.label = unicode(os.path.splitext(path)[0].replace('\\', '/'), sys.getfilesystemencoding(), 'replace') \
-                     .replace('/', u'\xa0\u25ba ').replace('--', u'\u2014')
+                     .replace('/', self.label_sep).replace('--', u'\u2014')
         self.present = True
 
     def __repr__(self):
         return "MediaFile(%r)" % self.path
 
     def fmt(self, prefix=""):
-        return "%s%d\t%s" % (prefix, id(self), self.label.encode('utf-8'))
+        return "%s%d\t%s" % (prefix, self.iid, self.label.encode('utf-8'))
 
     def _index_entry(self):
         self.present = False
@@ -299,19 +1096,125 @@ class MediaFile(object):
             self.path = new_path
         self.present = True
 
+    @staticmethod
+    def fmt_compact(files):
+        # tracks grouped by directory: a line '/N<tab>SUFFIX' switches to a
+        # directory label made of the first N UTF-16 code units of the
+        # previous directory label plus SUFFIX; track lines are 'ID<tab>NAME'
+        lines = []
+        prev = None
+        for f in files:
+            d, sep, name = f.label.rpartition(MediaFile.label_sep)
+            if d != prev:
+                common = os.path.commonprefix([prev or u'', d])
+                lines.append("/%d\t%s" % (len(common.encode('utf-16-le')) // 2, d[len(common):].encode('utf-8')))
+                prev = d
+            lines.append("%d\t%s" % (f.iid, name.encode('utf-8')))
+        return '\n'.join(lines)
+
     @staticmethod
     def make_key(name):
         return name.replace('\\', '/').lower()
     @staticmethod
     def make_path_key(path):
         return os.path.splitext(path)[0].replace('\\', '/').lower()
+    @staticmethod
+    def is_accepted(name):
+        return not(name.startswith('.')) and (os.path.splitext(name)[-1].strip('.').lower() in AcceptedExts)
+    @staticmethod
+    def make_fuzzy_key(name):
+        # ignores case, accents, punctuation and spacing
+        name = unicodedata.normalize('NFKD', name.decode('utf-8', 'replace'))
+        return u' '.join(re.findall(r'[^\W_]+', u''.join(c for c in name if not unicodedata.combining(c)).lower(), re.UNICODE))
+    @staticmethod
+    def make_fuzzy_parts(path):
+        return [MediaFile.make_fuzzy_key(p) for p in os.path.splitext(path.replace('\\', '/'))[0].split('/') if p]
+
+################################################################################
+
+def parse_playlist(data, base=None):
+    # M3U, M3U8 or PLS file contents -> list of UTF-8 paths; relative paths
+    # are taken relative to 'base' if given
+    if data.startswith('\xef\xbb\xbf'):
+        data = data[3:]
+    lines = []
+    for line in data.splitlines():
+        # each line on its own: plain .m3u files may mix Latin-1 titles
+        # with UTF-8 paths
+        try:
+            line = line.decode('utf-8')
+        except UnicodeDecodeError:
+            line = line.decode('cp1252', 'replace')
+        lines.append(line.encode('utf-8').strip())
+    if lines and (lines[0].lower() == "[playlist]"):
+        entries = [line.split('=', 1)[1].strip() for line in lines if re.match(r'file\d+=', line, re.I)]
+    else:
+        entries = [line for line in lines if line and not(line.startswith('#'))]
+    paths = []
+    for entry in entries:
+        if entry.lower().startswith("file://"):
+            entry = urllib.unquote(urlparse.urlparse(entry).path)
+        elif base and not(re.match(r'\w+://|[a-z]:[\\/]|[\\/]', entry, re.I)) and not(os.path.isabs(entry)):
+            entry = os.path.join(base, entry)
+        paths.append(entry)
+    return paths
+
+def format_playlist(files, fmt):
+    # generates the file in chunks; paths are relative to the content root
+    enc = 'latin-1' if (fmt == "m3u") else 'utf-8'
+    title = lambda f: f.label.replace(MediaFile.label_sep, u" - ").encode(enc, 'replace')
+    n = 0
+    if fmt == "pls":
+        yield "[playlist]\n"
+        for n, f in enumerate(files, 1):
+            yield "File%d=%s\nTitle%d=%s\nLength%d=-1\n" % (n, f.path, n, title(f), n)
+        yield "NumberOfEntries=%d\nVersion=2\n" % n
+    else:
+        yield "#EXTM3U\n"
+        for f in files:
+            yield "#EXTINF:-1,%s\n%s\n" % (title(f), f.path)
+
+class AdoptedProcess(object):
+    # stand-in for the subprocess.Popen object of a player that was started
+    # by a previous instance of the program (see Handover)
+    def __init__(self, pid, stdout_fd=None):
+        self.pid = pid
+        self.returncode = None
+        self.stdout = os.fdopen(stdout_fd, "rb") if (stdout_fd is not None) else None
+
+    def poll(self):
+        if self.returncode is None:
+            try:
+                pid, status = os.waitpid(self.pid, os.WNOHANG)
+                if pid:
+                    self.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+            except OSError, e:
+                # not our child; all we can do is check whether it's alive
+                if e.errno != errno.ECHILD:
+                    raise
+                try:
+                    os.kill(self.pid, 0)
+                except OSError, e:
+                    if e.errno == errno.ESRCH:
+                        self.returncode = -1
+        return self.returncode
+
+    def send_signal(self, sig):
+        try:
+            os.kill(self.pid, sig)
+        except OSError:
+            pass
 
 class ListManager(object):
     root = '.'
-    mutex = threading.Lock()
+    mutex = TimedLock("ListManager")
     files = []
+    keys = []
+    by_iid = {}
+    folders = {}
+    folder_names = []
     current = None
-    playlist = []
+    playlist = IndexedList()
     history = []
     playcounts = collections.defaultdict(int)
     statefile = DefaultStateFile
@@ -319,16 +1222,33 @@ class ListManager(object):
     running = False
     player = None
     cmdline = []
+    player_cmdline = []  # the one the running player has been started with
     fail_count = 0
     started_at = None
+    player_exited_at = None
     autoscan = False
     autosave = (sys.platform == "win32")
     scan_tag = None
     maxhist = DefaultHistoryDepth
+    scan_threads = DefaultScanThreads
+    lookahead = DefaultLookahead
+    folder_spread = DefaultFolderSpread
     retcode = None
     first_in_session = True
-    u_tracklist = None
-    z_tracklist = None
+    player_log = None
+    state_version = 0
+    playlist_version = 0
+    history_version = 0
+    session_tag = "%x" % int(time.time())
+    list_bodies = {}
+    coalesce_window = DefaultCoalesceWindow
+    skip_mutex = threading.Lock()
+    pending_skip = 0
+    skip_done = None
+    tracklists = {}
+    fuzzy_index = None
+    duplicates = {}
+    state_loaded = False
 
     @classmethod
     def load_state(self, filename=None):
@@ -336,29 +1256,79 @@ class ListManager(object):
             if filename:
                 self.statefile = filename
             self.history = []
-            self.playlist = []
+            self.playlist = IndexedList()
             self.is_auto_playlist = False
-            try:
-                with open(self.statefile) as state:
-                    lineno = 0
-                    for line in state:
-                        lineno += 1
-                        line = line.strip()
-                        if line.startswith('-'):
-                            self._locked_search(line[1:], self.history)
-                        elif line.startswith('+'):
-                            self._locked_search(line[1:], self.playlist)
-                        elif line.startswith('=') and ('*' in line):
-                            c, n = map(str.strip, line[1:].split('*', 1))
-                            try:
-                                self.playcounts[MediaFile.make_key(n)] = int(c)
-                            except ValueError:
-                                pass
-                        elif line and not(line.startswith(('#', ';'))):
-                            print >>sys.stderr, "syntax error in %s:%d: '%s'" % (self.statefile, lineno, line)
-            except EnvironmentError:
-                pass
+            if Database.enabled and Database.has_state():
+                self._locked_load_database()
+            else:
+                self._locked_load_text(self.statefile)
+                if Database.enabled:
+                    log("importing state file '%s' into the database" % self.statefile)
+                    Database.import_state(self.history, self.playlist, self.playcounts)
+            if self.current and self.playlist and (self.playlist[0] is self.current):
+                del self.playlist[0]  # already started before the scan
+            self.state_loaded = True
+            self._locked_changed()
             self._locked_refill()
+    @classmethod
+    def peek_resume(self, filename):
+        # key of the first saved playlist entry (or None), read without
+        # needing the library
+        if Database.enabled and Database.has_state():
+            return Database.first_queued()
+        try:
+            with open(filename) as state:
+                for line in state:
+                    if line.startswith('+'):
+                        return MediaFile.make_key(line[1:].strip())
+        except EnvironmentError:
+            pass
+        return None
+    @classmethod
+    def _locked_load_text(self, filename):
+        try:
+            with open(filename) as state:
+                lineno = 0
+                for line in state:
+                    lineno += 1
+                    line = line.strip()
+                    if line.startswith('-'):
+                        self._locked_search(line[1:], self.history)
+                    elif line.startswith('+'):
+                        self._locked_search(line[1:], self.playlist)
+                    elif line.startswith('=') and ('*' in line):
+                        c, n = map(str.strip, line[1:].split('*', 1))
+                        try:
+                            self.playcounts[MediaFile.make_key(n)] = int(c)
+                        except ValueError:
+                            pass
+                    elif line and not(line.startswith(('#', ';'))):
+                        print >>sys.stderr, "syntax error in %s:%d: '%s'" % (filename, lineno, line)
+        except EnvironmentError:
+            pass
+    @classmethod
+    def _locked_load_database(self):
+        history, playlist, playcounts = Database.load_state()
+        self.history = filter(None, map(self._locked_find, history))
+        self.playlist = IndexedList(filter(None, map(self._locked_find, playlist)))
+        self.playcounts.clear()
+        self.playcounts.update(playcounts)
+
+    @classmethod
+    def import_state(self, filename):
+        # replaces the database's history, playlist and play counts
+        with self.mutex:
+            self.history = []
+            self.playlist = IndexedList()
+            self.playcounts.clear()
+            self._locked_load_text(filename)
+            Database.import_state(self.history, self.playlist, self.playcounts)
+            Database.flush()
+
+    @classmethod
+    def export_state(self, filename):
+        with self.mutex:
+            self._locked_write_text(filename)
 
     @classmethod
     def save_state(self, filename=None, sort=True):
@@ -368,8 +1338,19 @@ class ListManager(object):
             self._locked_save(sort=sort)
     @classmethod
     def _locked_save(self, sort=True):
+        if not self.state_loaded:
+            return  # don't replace the saved state by an empty one
+        t0 = time.time()
+        if Database.enabled:
+            # play counts are already stored with every play
+            Database.save_queue(self.history[-self.maxhist:], [] if self.is_auto_playlist else self.playlist)
+        else:
+            self._locked_write_text(self.statefile, sort)
+        Metrics.observe("kjukebox_state_save_seconds", time.time() - t0)
+    @classmethod
+    def _locked_write_text(self, filename, sort=True):
         try:
-            with open(self.statefile, "w") as state:
+            with open(filename, "w") as state:
                 state.write("# kjukebox %s state [%s]\n\n" % (__version__, time.strftime("%Y-%m-%d %H:%M:%S")))
                 if self.history or (self.playlist and not(self.is_auto_playlist)):
                     state.write("# history and playlist\n")
@@ -391,97 +1372,418 @@ class ListManager(object):
         except EnvironmentError, e:
             log("WARNING: failed to save play counts - %s" % e, True)
 
+    @classmethod
+    def configure(self, args):
+        with self.mutex:
+            self.autoscan = args.autoscan
+            self.autosave = args.autosave
+            self.maxhist = args.maxhist
+            self.scan_threads = args.scanthreads
+            self.lookahead = args.lookahead
+            self.folder_spread = args.spread
+            self.coalesce_window = args.coalesce
+            if len(self.history) > self.maxhist:
+                del self.history[:len(self.history) - self.maxhist]
+                self._locked_changed(history=True)
+            if self.is_auto_playlist and (len(self.playlist) > max(1, self.lookahead)):
+                del self.playlist[max(1, self.lookahead):]
+                self._locked_changed(playlist=True)
+            self._locked_refill()
+
+    @classmethod
+    def redraw_status(self):
+        with self.mutex:
+            if not self.player:
+                StatusScreen.update(prev=(self.history[-1] if self.history else None))
+
+    @classmethod
+    def _locked_snapshot(self):
+        # everything a successor process needs to continue seamlessly;
+        # tracks are referenced by ID, so web clients stay in sync
+        ids = lambda files: [f.iid for f in files]
+        entries = lambda files: [(f.iid, f.path, f.key) for f in files]
+        # the history may still refer to tracks that have been deleted
+        deleted = dict((f.iid, f) for f in self.history + [self.current] if f and not(f.present))
+        return {
+            "format": HandoverFormat,
+            "root": self.root,
+            "files": entries(self.files),
+            "deleted": entries(deleted.values()),
+            "scan_tag": self.scan_tag,
+            "history": ids(self.history),
+            "playlist": ids(self.playlist),
+            "current": self.current.iid if self.current else None,
+            "is_auto_playlist": self.is_auto_playlist,
+            "running": self.running,
+            "playcounts": dict(self.playcounts),
+            "state_version": self.state_version,
+            "first_in_session": self.first_in_session,
+            "fail_count": self.fail_count,
+            "player": self.player.pid if self.player else None,
+            "player_stdout": self.player.stdout.fileno() if (self.player and self.player.stdout) else None,
+            "player_cmdline": self.player_cmdline,
+            "started_at": self.started_at,
+            "player_exited_at": self.player_exited_at,
+        }
+
+    @classmethod
+    def restore(self, snap):
+        # counterpart of _locked_snapshot(); a player that is still running
+        # is adopted and will be noticed by tick() when it exits
+        with self.mutex:
+            files = {}
+            for iid, path, key in snap["files"] + snap["deleted"]:
+                f = files[iid] = MediaFile(path, key)
+                f.iid = iid
+            for iid, path, key in snap["deleted"]:
+                files[iid].present = False
+            self.files = [files[iid] for iid, path, key in snap["files"]]
+            MediaFile.iid_counter = itertools.count(max(files or [0]) + 1)
+            self.scan_tag = snap["scan_tag"]
+            self._locked_index_library()
+            self.history = [files[iid] for iid in snap["history"]]
+            self.playlist = IndexedList(files[iid] for iid in snap["playlist"])
+            self.current = files.get(snap["current"])
+            self.playcounts.clear()
+            self.playcounts.update(snap["playcounts"])
+            for name in ("is_auto_playlist", "running", "state_version", "first_in_session", "fail_count", "started_at", "player_exited_at"):
+                setattr(self, name, snap[name])
+            self.playlist_version = self.history_version = self.state_version
+            self.state_loaded = True
+            Metrics.set("kjukebox_library_files", len(self.files))
+            if snap["player"]:
+                self.player = AdoptedProcess(snap["player"], snap["player_stdout"])
+                self.player_cmdline = snap.get("player_cmdline") or self.cmdline
+                log("adopted running player (PID %d)" % self.player.pid)
+                if self.player.stdout:
+                    pump = threading.Thread(target=player_output_pump, args=(self.player.stdout, self.player_log or nulldev()), name="PlayerOutput")
+                    pump.daemon = True
+                    pump.start()
+            if snap["root"] != self.root:
+                log("WARNING: content directory changed, rescanning")
+                self._locked_rescan()
+            else:
+                self._locked_refill()
+
     @classmethod
     def set_root(self, path):
         self.root = os.path.normpath(os.path.abspath(path))
 
     @classmethod
     def rescan(self):
+        # the directory tree is read in the calling thread, without holding
+        # the lock or keeping the engine busy; only the merge is a command
+        t0 = time.time()
+        tree = self._walk()
+        return Engine.call(self._merge_scan, tree, t0)
+    @classmethod
+    def _merge_scan(self, tree, t0):
         with self.mutex:
-            self._locked_rescan()
+            self._locked_rescan(tree, t0)
+            return self.state_version
     @classmethod
-    def _locked_rescan(self):
+    def _walk(self):
+        if self.scan_threads > 1:
+            return walk_parallel(self.root, self.scan_threads)
+        return list(walk_sequential(self.root))
+    @classmethod
+    def _locked_rescan(self, tree=None, t0=None):
+        t0 = t0 or time.time()
+        if tree is None:
+            tree = self._walk()
         index = dict(f._index_entry() for f in self.files)
         n_new = 0
-        for base, dirs, files in os.walk(self.root):
-            assert base.startswith(self.root)
-            base = base[len(self.root):].lstrip('\\/')
+        new_files = []
+        for base, files in tree:
             for f in files:
-                if not(f.startswith('.')) and (os.path.splitext(f)[-1].strip('.').lower() in AcceptedExts):
+                if MediaFile.is_accepted(f):
                     f = os.path.join(base, f)
                     key = MediaFile.make_path_key(f)
                     try:
                         index[key]._mark_present(f)
                     except KeyError:
-                        f = MediaFile(f, key)
+                        if self.current and not(self.current.present) and (self.current.key == key):
+                            # keep the playing track, e.g. one that has
+                            # been started before the initial scan
+                            self.current._mark_present(f)
+                            f = self.current
+                        else:
+                            f = MediaFile(f, key)
                         self.files.append(f)
                         index[key] = f
                         n_new += 1
+                        new_files.append(f)
+        if Database.enabled:
+            Database.sync_library(new_files, [f for f in self.files if not f.present])
         n_del = len(self.files)
         self.files = [f for f in self.files if f.present]
         n_del -= len(self.files)
         self.files.sort(key=lambda f: f.key)
-        self.playlist = [f for f in self.playlist if f.present]
+        if n_del:
+            self.playlist = IndexedList(f for f in self.playlist if f.present)
+            self._locked_changed(playlist=True)
         if n_new or n_del:
             log("rescan finished: %d new track(s), %d track(s) deleted" % (n_new, n_del))
             self.scan_tag = str(int(time.time()))
-            self.u_tracklist = '\n'.join(f.fmt() for f in self.files)
-            self.z_tracklist = zlib.compress(self.u_tracklist, 9)
+            self._locked_index_library()
+        Transcoder.schedule(os.path.join(self.root, f.path) for f in new_files)
+        Metrics.observe("kjukebox_rescan_seconds", time.time() - t0)
+        Metrics.inc("kjukebox_rescan_new_files_total", n_new)
+        Metrics.inc("kjukebox_rescan_deleted_files_total", n_del)
+        Metrics.set("kjukebox_library_files", len(self.files))
         self._locked_refill()
 
     @classmethod
-    def get_tracklist(self):
-        with self.mutex:
-            for f in self.files:
-                yield f.fmt()
+    def _locked_index_library(self):
+        self._locked_index_folders()
+        self.by_iid = dict((f.iid, f) for f in self.files)
+        self.keys = [f.key for f in self.files]
+        old, self.tracklists = self.tracklists, {}
+        for compact, data in ((False, '\n'.join(f.fmt() for f in self.files)), (True, MediaFile.fmt_compact(self.files))):
+            self.tracklists[(compact, False)] = ResponseCache.store("tracklist", data)
+            self.tracklists[(compact, True)] = ResponseCache.store("tracklist", zlib.compress(data, 9))
+        for body in old.itervalues():
+            body.discard()
+        self.fuzzy_index = None  # rebuilt on demand
+        Deduplicator.schedule(self.root, [(f.key, f.path) for f in self.files])
+        Loudness.sync(self.root, [f.path for f in self.files])
+        Transcoder.sync(self.root, [f.path for f in self.files])
 
     @classmethod
-    def get_tracklist_str(self, deflate=False):
+    def set_duplicates(self, groups):
+        # groups = lists of keys of identical files
         with self.mutex:
-            return self.z_tracklist if deflate else self.u_tracklist
+            self.duplicates = {}
+            for keys in groups:
+                keys = tuple(keys)
+                for key in keys:
+                    self.duplicates[key] = keys
+            Metrics.set("kjukebox_duplicate_groups", len(groups))
 
     @classmethod
-    def get_playlist(self):
+    def get_duplicates(self):
         with self.mutex:
-            if self.current:
-                yield self.current.fmt('+')
-            prefix = '-' if self.is_auto_playlist else ''
-            for f in self.playlist:
-                yield f.fmt(prefix)
+            groups = sorted(set(self.duplicates.itervalues()))
+            return [filter(None, map(self._locked_find, keys)) for keys in groups]
 
     @classmethod
-    def get_history(self):
-        with self.mutex:
-            for f in self.history:
-                yield f.fmt()
-            if self.current:
-                yield self.current.fmt('+')
+    def _locked_identity(self, f):
+        # the same for all copies of a track
+        return self.duplicates.get(f.key, (f.key,))[0]
 
     @classmethod
-    def _locked_lookup(self, iid):
-        if isinstance(iid, MediaFile):
-            return iid
-        try:
-            iid = int(iid)
-        except ValueError:
-            return
-        for f in self.files:
-            if id(f) == iid:
-                return f
+    def _locked_playcount(self, f):
+        return sum(self.playcounts[key] for key in self.duplicates.get(f.key, (f.key,)))
 
     @classmethod
-    def _locked_search(self, name, append_to=None):
-        key = MediaFile.make_key(name)
+    def _locked_index_folders(self):
+        self.folders = collections.defaultdict(list)
         for f in self.files:
-            if f.key == key:
-                if not(append_to is None):
-                    append_to.append(f)
-                return f
+            self.folders[f.folder].append(f)
+        self.folder_names = sorted(self.folders)
 
     @classmethod
-    def _locked_checkpoint(self):
-        if self.autosave:
-            self._locked_save()
+    def _locked_folder_range(self, folder):
+        # self.files is sorted by key, so all tracks inside a folder form a
+        # contiguous range that can be found by binary search
+        prefix = MediaFile.make_key(folder).strip('/')
+        if not prefix:
+            return ('', 0, len(self.keys))
+        prefix += '/'
+        lo = bisect.bisect_left(self.keys, prefix)
+        hi = bisect.bisect_left(self.keys, prefix[:-1] + '0', lo)  # '0' follows '/'
+        return (prefix, lo, hi)
+
+    @classmethod
+    def get_folder(self, folder):
+        with self.mutex:
+            prefix, i, hi = self._locked_folder_range(folder)
+            depth = prefix.count('/')
+            while i < hi:
+                rest = self.keys[i][len(prefix):]
+                if '/' in rest:
+                    sub = prefix + rest.split('/', 1)[0]
+                    j = bisect.bisect_left(self.keys, sub + '0', i, hi)
+                    name = self.files[i].label.split(MediaFile.label_sep)[depth]
+                    yield "/%s\t%s\t%d" % (sub, name.encode('utf-8'), j - i)
+                    i = j
+                else:
+                    f = self.files[i]
+                    yield "%d\t%s" % (f.iid, f.label.rpartition(MediaFile.label_sep)[2].encode('utf-8'))
+                    i += 1
+
+    @classmethod
+    def add_folder(self, folder, shuffle=False):
+        with self.mutex:
+            prefix, lo, hi = self._locked_folder_range(folder)
+            files = self.files[lo:hi]
+            if shuffle:
+                random.shuffle(files)
+            for f in files:
+                self._locked_add_to_back(f)
+            return self.state_version
+
+    @classmethod
+    def get_tracklist(self):
+        with self.mutex:
+            for f in self.files:
+                yield f.fmt()
+
+    @classmethod
+    def get_tracklist_body(self, deflate=False, compact=False):
+        with self.mutex:
+            return self.tracklists.get((compact, deflate))
+
+    @classmethod
+    def get_tracklists(self):
+        with self.mutex:
+            return self.scan_tag, self.tracklists
+
+    @classmethod
+    def get_tracklist_str(self, deflate=False, compact=False):
+        body = self.get_tracklist_body(deflate, compact)
+        return body.read() if body else None
+
+    @classmethod
+    def _locked_playlist_items(self):
+        prefix = '-' if self.is_auto_playlist else ''
+        items = [f.fmt(prefix) for f in self.playlist]
+        if self.current:
+            items.insert(0, self.current.fmt('+'))
+        return items
+
+    @classmethod
+    def _locked_history_items(self):
+        items = [f.fmt() for f in self.history]
+        if self.current:
+            items.append(self.current.fmt('+'))
+        return items
+
+    @classmethod
+    def get_list_body(self, name, deflate=False):
+        # /playlist or /history as (state version, ETag, body); the body is
+        # cached until the list changes
+        with self.mutex:
+            version = self.history_version if (name == "history") else self.playlist_version
+            cached = self.list_bodies.get((name, deflate))
+            if not(cached) or (cached[0] != version):
+                data = '\n'.join(self._locked_history_items() if (name == "history") else self._locked_playlist_items())
+                if deflate:
+                    data = zlib.compress(data, 6)
+                cached = self.list_bodies[(name, deflate)] = (version, data)
+            return self.state_version, "%s-%s%d" % (self.session_tag, name[0], version), cached[1]
+
+    @classmethod
+    def _locked_changed(self, playlist=False, history=False):
+        # without arguments, both lists (or the current track) changed
+        self.state_version += 1
+        if playlist or not(history):
+            self.playlist_version = self.state_version
+        if history or not(playlist):
+            self.history_version = self.state_version
+
+    @classmethod
+    def _locked_lookup(self, iid):
+        if isinstance(iid, MediaFile):
+            return iid
+        try:
+            return self.by_iid.get(int(iid))
+        except (TypeError, ValueError):
+            return
+
+    @classmethod
+    def get_file(self, iid):
+        with self.mutex:
+            return self._locked_lookup(iid)
+
+    @classmethod
+    def get_files_by_key(self, keys):
+        with self.mutex:
+            return map(self._locked_find, keys)
+
+    @classmethod
+    def _locked_find(self, key):
+        i = bisect.bisect_left(self.keys, key)
+        if (i < len(self.keys)) and (self.keys[i] == key):
+            return self.files[i]
+
+    @classmethod
+    def _locked_search(self, name, append_to=None):
+        f = self._locked_find(MediaFile.make_key(name))
+        if f and not(append_to is None):
+            append_to.append(f)
+        return f
+
+    @classmethod
+    def _locked_resolve(self, path):
+        # playlist file entry -> track, either by its exact key or by the
+        # best unique match of the normalized file name and as many of the
+        # parent directory names as possible
+        if re.match(r'\w+://', path):
+            return None
+        root = self.root.replace('\\', '/').rstrip('/') + '/'
+        path = path.replace('\\', '/')
+        if path.lower().startswith(root.lower()):
+            path = path[len(root):]
+        f = self._locked_find(MediaFile.make_path_key(path.lstrip('/')))
+        if f:
+            return f
+        if self.fuzzy_index is None:
+            self.fuzzy_index = collections.defaultdict(list)
+            for f in self.files:
+                self.fuzzy_index[MediaFile.make_fuzzy_parts(f.path)[-1]].append(f)
+        parts = MediaFile.make_fuzzy_parts(path)
+        if not parts:
+            return None
+        best, best_score = None, -1
+        for f in self.fuzzy_index.get(parts[-1], ()):
+            score = 0
+            for a, b in zip(reversed(parts), reversed(MediaFile.make_fuzzy_parts(f.path))):
+                if a != b:
+                    break
+                score += 1
+            if score > best_score:
+                best, best_score = f, score
+            elif score == best_score:
+                best = None  # ambiguous
+        return best
+
+    @classmethod
+    def import_playlist(self, paths, replace=False):
+        # bulk version of add_to_back(); returns the new state version and
+        # the entries that could not be matched
+        with self.mutex:
+            found, missing = [], []
+            for path in paths:
+                f = self._locked_resolve(path)
+                if f:
+                    found.append(f)
+                else:
+                    missing.append(path)
+            if replace or (found and self.is_auto_playlist):
+                self.playlist = IndexedList(found)
+                self.is_auto_playlist = False
+            else:
+                self.playlist.splice(len(self.playlist), found)
+            if found or replace:
+                self._locked_changed(playlist=True)
+            self._locked_refill()
+            return self.state_version, missing
+
+    @classmethod
+    def get_list_files(self, name):
+        # copies just the references, so exports can be generated without
+        # holding the lock
+        with self.mutex:
+            current = [self.current] if self.current else []
+            if name == "history":
+                return self.history + current
+            return current + list(self.playlist)
+
+    @classmethod
+    def _locked_checkpoint(self):
+        if self.autosave:
+            self._locked_save()
         if self.autoscan:
             self._locked_rescan()
 
@@ -491,6 +1793,7 @@ class ListManager(object):
             f = self._locked_lookup(iid)
             if not f: return
             self._locked_add_to_front(f)
+            return self.state_version
     @classmethod
     def _locked_add_to_front(self, f):
         try:
@@ -498,38 +1801,94 @@ class ListManager(object):
         except ValueError:
             pass
         if self.is_auto_playlist:
-            self.playlist = [f]
+            self.playlist = IndexedList([f])
             self.is_auto_playlist = False
         else:
             self.playlist.insert(0, f)
+        self._locked_changed(playlist=True)
 
     @classmethod
     def add_to_back(self, iid):
         with self.mutex:
             f = self._locked_lookup(iid)
             if not f: return
-            if self.is_auto_playlist or not(self.playlist):
-                self.playlist = [f]
-                self.is_auto_playlist = False
-            else:
-                self.playlist.append(f)
+            self._locked_add_to_back(f)
+            return self.state_version
+    @classmethod
+    def _locked_add_to_back(self, f):
+        if self.is_auto_playlist or not(self.playlist):
+            self.playlist = IndexedList([f])
+            self.is_auto_playlist = False
+        else:
+            self.playlist.append(f)
+        self._locked_changed(playlist=True)
 
     @classmethod
-    def _locked_refill(self):
-        if self.playlist:
-            return  # playlist still populated
-        # generate list of all files (except current and those in history)
-        filelist = [f for f in self.files if (f != self.current) and not(f in self.history)]
-        # if empty, try again with, now including history
-        if not filelist:
-            filelist = [f for f in self.files if (f != self.current)]
-        if not filelist:
-            return  # still empty -> there's no file to select at all
-        # draw some files from the pool
-        filelist = random.sample(filelist, max(1, int(math.sqrt(len(filelist)) + 0.9)))
+    def move(self, iid, pos):
+        with self.mutex:
+            f = self._locked_lookup(iid)
+            try:
+                pos = int(pos)
+            except (TypeError, ValueError):
+                return
+            if f and self._locked_move(f, pos):
+                return self.state_version
+    @classmethod
+    def _locked_move(self, f, pos):
+        if not self.playlist.move(f, max(0, pos)):
+            return False
+        self._locked_changed(playlist=True)
+        return True
+
+    @classmethod
+    def _locked_refill(self, count=1):
+        if self.playlist and not(self.is_auto_playlist):
+            return  # manual playlist still populated
+        while len(self.playlist) < max(count, self.lookahead):
+            f = self._locked_draw()
+            if not f:
+                return  # there's no file to select at all
+            self.playlist.append(f)
+            self.is_auto_playlist = True
+            self._locked_changed(playlist=True)
+
+    @classmethod
+    def _locked_draw(self):
+        # tracks that are playing, queued or have been played recently
+        seq = [f for f in ((self.history[-self.folder_spread:] if self.folder_spread else []) + [self.current] + list(self.playlist)) if f]
+        # duplicates count as one track: only the first copy is ever drawn,
+        # and it's busy if any copy is
+        ident = self._locked_identity
+        busy = set(ident(f) for f in self.history[-self.maxhist:])
+        busy.update(ident(f) for f in seq)
+        # top-level folders of the last few tracks are avoided
+        n_avoid = min(self.folder_spread, len(self.folder_names) - 1)
+        avoid = set(f.folder for f in seq[-n_avoid:]) if (n_avoid > 0) else set()
+        # draw candidates from random folders, so that big folders don't
+        # dominate; the number of draws doesn't depend on the library size
+        n_cand = max(1, int(math.sqrt(len(self.files)) + 0.9))
+        candidates = []
+        for i in xrange(8 * n_cand):
+            if not self.folder_names:
+                break
+            folder = random.choice(self.folder_names)
+            if folder in avoid:
+                continue
+            f = random.choice(self.folders[folder])
+            if (ident(f) == f.key) and not(f.key in busy):
+                candidates.append(f)
+                if len(candidates) >= n_cand:
+                    break
+        if not candidates:
+            # random draws failed (most tracks have been played recently),
+            # so search the whole library, relaxing the constraints if needed
+            candidates = [f for f in self.files if (ident(f) == f.key) and not(f.key in busy) and not(f.folder in avoid)] \
+                      or [f for f in self.files if (ident(f) == f.key) and not(f in seq)]
+            if not candidates:
+                return
+            candidates = random.sample(candidates, min(n_cand, len(candidates)))
         # decorate list with play count and random number, select minimum
-        self.playlist = [min((self.playcounts[f.key], random.random(), f) for f in filelist)[-1]]
-        self.is_auto_playlist = True
+        return min((self._locked_playcount(f), random.random(), f) for f in candidates)[-1]
 
     @classmethod
     def remove_file(self, iid):
@@ -537,29 +1896,81 @@ class ListManager(object):
             f = self._locked_lookup(iid)
             if not f: return
             if f == self.current:
-                return self._locked_next()
-            try:
-                self.playlist.remove(f)
-            except ValueError:
-                return  # item not found
+                self._locked_next()
+            elif not self._locked_remove(f):
+                return
+            return self.state_version
+    @classmethod
+    def _locked_remove(self, f):
+        try:
+            self.playlist.remove(f)
+        except ValueError:
+            return False  # item not found
+        self._locked_changed(playlist=True)
+        self._locked_refill()
+        return True
+
+    @classmethod
+    def batch(self, ops):
+        # apply a list of (command, id[, position]) tuples in one critical
+        # section; the player is restarted at most once, at the very end
+        failed = []
+        with self.mutex:
+            action = None
+            for op in ops:
+                f = self._locked_lookup(op[1]) if (len(op) > 1) else None
+                if not(f) or not(op[0] in BatchOps):
+                    failed.append(op)
+                elif op[0] == "add":
+                    self._locked_add_to_back(f)
+                elif op[0] == "insert":
+                    self._locked_add_to_front(f)
+                elif op[0] == "playnow":
+                    self._locked_add_to_front(f)
+                    action = "playnow"
+                elif op[0] == "remove":
+                    if f == self.current:
+                        action = action or "next"
+                    elif not self._locked_remove(f):
+                        failed.append(op)
+                elif op[0] == "move":
+                    try:
+                        pos = int(op[2])
+                    except (IndexError, ValueError):
+                        pos = None
+                    if (pos is None) or not(self._locked_move(f, pos)):
+                        failed.append(op)
+            if action == "playnow":
+                self.running = True
+                self._locked_stop()
+                self._locked_play()
+            elif action == "next":
+                self._locked_next()
             self._locked_refill()
+            return self.state_version, failed
 
     @classmethod
     def _locked_stop(self, return_to_playlist=False, always_add_to_playcounts=False):
+        if self.current or self.player:
+            self._locked_changed()
         if self.current:
             log("stopping '%s'" % self.current.path)
             if not return_to_playlist:
                 self.history.append(self.current)
             elif self.is_auto_playlist:
-                self.playlist = [self.current]
+                self.playlist = IndexedList([self.current])
             else:
                 self.playlist.insert(0, self.current)
             if not self.running:
                 StatusScreen.update(prev=self.current)
-            if always_add_to_playcounts or not(self.started_at) or ((time.time() - self.started_at) >= MinPlayTime):
+            counted = always_add_to_playcounts or not(self.started_at) or ((time.time() - self.started_at) >= MinPlayTime)
+            if counted:
                 self.playcounts[self.current.key] += 1
             else:
                 log("not adding to playcounts (only played for %.1f seconds)" % (time.time() - self.started_at))
+            if Database.enabled:
+                Database.record_play(self.current.key, self.started_at or time.time(),
+                                     (time.time() - self.started_at) if self.started_at else None, counted)
             if not self.running:
                 self._locked_checkpoint()
             self.current = None
@@ -567,7 +1978,8 @@ class ListManager(object):
             log("killing player executable")
             timeout = time.time() + 2.0
             kill = True
-            if ("omxplayer" in self.cmdline[0]) and not("omxplayer.bin" in self.cmdline[0]):
+            player = (self.player_cmdline or self.cmdline)[0]
+            if ("omxplayer" in player) and not("omxplayer.bin" in player):
                 kill = bool(subprocess.call(["killall", "-2", "omxplayer.bin"]))
             if kill:
                 self.player.send_signal(15 if (sys.platform == "win32") else 2)
@@ -577,6 +1989,7 @@ class ListManager(object):
                     break
                 time.sleep(0.01)
             self.player = None
+            self.player_exited_at = time.time()
         self.started_at = None
 
     @classmethod
@@ -589,6 +2002,7 @@ class ListManager(object):
             self.running = False
             return
         self.current = self.playlist[0]
+        self._locked_changed()
         StatusScreen.update(prev=(self.history[-1] if (self.history and not(self.first_in_session)) else None),
                             next=self.current)
         self.first_in_session = False
@@ -598,25 +2012,71 @@ class ListManager(object):
         self._locked_refill()
         if set_running:
             self.running = True
+        self._locked_start_player()
+    @classmethod
+    def _locked_start_player(self):
         path = os.path.join(self.root, self.current.path)
-        cmdline = [(path if (x == '$') else x) for x in self.cmdline]
+        gain = Loudness.gain(path)
+        cached = Transcoder.lookup(path)
+        if cached:
+            log("using transcoded version '%s'" % cached)
+            path = cached
+        if self.playlist:
+            # give the next track a head start in the background queues
+            Transcoder.schedule([os.path.join(self.root, self.playlist[0].path)], 0)
+            Loudness.schedule([os.path.join(self.root, self.playlist[0].path)], 0)
+        cmdline = []
+        for x in self.cmdline:
+            if x == '$':
+                cmdline.extend(player_gain_args(self.cmdline, gain))
+                x = path
+            cmdline.append(x)
         pretty_cmdline = ' '.join((('"%s"' % x) if (' ' in x) else x) for x in cmdline)
         log("+ " + pretty_cmdline)
         try:
-            self.player = subprocess.Popen(cmdline, stdin=nulldev(), stdout=(logfile or nulldev()), stderr=subprocess.STDOUT)
+            t0 = time.time()
+            self.player = subprocess.Popen(cmdline, stdin=nulldev(), stdout=(subprocess.PIPE if self.player_log else nulldev()), stderr=subprocess.STDOUT)
+            self.player_cmdline = cmdline
+            StatusScreen.covered = True
+            if self.player_log:
+                pump = threading.Thread(target=player_output_pump, args=(self.player.stdout, self.player_log), name="PlayerOutput")
+                pump.daemon = True
+                pump.start()
             self.started_at = time.time()
+            Metrics.observe("kjukebox_player_spawn_seconds", self.started_at - t0)
+            Metrics.inc("kjukebox_player_starts_total")
+            if self.player_exited_at:
+                Metrics.observe("kjukebox_transition_gap_seconds", self.started_at - self.player_exited_at)
+            self.player_exited_at = None
         except EnvironmentError, e:
             log("ERROR: failed to start video player - %s" % e, True)
-            print >>sys.stderr, "Failed command line was:"
-            print >>sys.stderr, "  " + pretty_cmdline
+            log("Failed command line was:\n  " + pretty_cmdline, True)
             self.running = False
             self.player = None
             self._locked_stop(True)
 
+    @classmethod
+    def play_early(self, path):
+        # starts a track while the initial scan is still running; the scan
+        # then adopts it instead of adding a second copy
+        with self.mutex:
+            if self.current or self.player or self.files or self.scan_tag:
+                return False  # too late
+            self.current = MediaFile(path, MediaFile.make_path_key(path))
+            self.current.present = False  # not in the library yet
+            self.running = True
+            self.first_in_session = False
+            self._locked_changed()
+            StatusScreen.update(next=self.current)
+            log("playing '%s' before the scan has finished" % path)
+            self._locked_start_player()
+            return bool(self.player)
+
     @classmethod
     def next(self):
         with self.mutex:
             self._locked_next(True)
+            return self.state_version
     @classmethod
     def _locked_next(self, force_play=False):
         self._locked_stop()
@@ -626,11 +2086,60 @@ class ListManager(object):
     @classmethod
     def prev(self):
         with self.mutex:
-            if not self.history:
-                return
+            self._locked_skip(-1)
+            return self.state_version
+
+    @classmethod
+    def skip(self, delta):
+        # skips that arrive within a short window are merged into a single
+        # one, so that the player is restarted only once
+        if self.coalesce_window <= 0:
+            return Engine.call(self._skip_now, delta)
+        with self.skip_mutex:
+            self.pending_skip += delta
+            done = self.skip_done
+            if done:
+                Metrics.inc("kjukebox_skips_coalesced_total")
+            else:
+                done = self.skip_done = threading.Event()
+                timer = threading.Timer(self.coalesce_window, self._flush_skip)
+                timer.daemon = True
+                timer.start()
+        done.wait()
+        return getattr(done, "version", None)
+    @classmethod
+    def _flush_skip(self):
+        with self.skip_mutex:
+            delta, self.pending_skip = self.pending_skip, 0
+            done, self.skip_done = self.skip_done, None
+        try:
+            done.version = Engine.call(self._skip_now, delta)
+        finally:
+            done.set()
+    @classmethod
+    def _skip_now(self, delta):
+        with self.mutex:
+            self._locked_skip(delta)
+            return self.state_version
+    @classmethod
+    def _locked_skip(self, delta):
+        if delta > 0:
+            self._locked_stop()
+            for n in xrange(delta, 1, -1):
+                # draw all automatic tracks at once, so they are distinct
+                self._locked_refill(n)
+                if not self.playlist:
+                    break
+                log("skipping '%s'" % self.playlist.pop(0).path)
+            self._locked_play(True)
+        elif (delta < 0) and self.history:
             self._locked_stop(True)
-            self.playlist.insert(0, self.history.pop())
+            if self.is_auto_playlist:
+                del self.playlist[1:]
+            self.playlist.splice(0, self.history[delta:])
+            del self.history[delta:]
             self.is_auto_playlist = False
+            self._locked_changed()
             self._locked_play(True)
 
     @classmethod
@@ -638,12 +2147,14 @@ class ListManager(object):
         with self.mutex:
             self._locked_stop(True)
             self._locked_play(True)
+            return self.state_version
 
     @classmethod
     def stop(self):
         with self.mutex:
             self.running = False
             self._locked_stop()
+            return self.state_version
 
     @classmethod
     def play_specific(self, iid):
@@ -654,6 +2165,7 @@ class ListManager(object):
             self.running = True
             self._locked_stop()
             self._locked_play()
+            return self.state_version
 
     @classmethod
     def rewind_to(self, iid):
@@ -662,11 +2174,15 @@ class ListManager(object):
             if not(f) or not(f in self.history): return
             self._locked_stop(True)
             idx = max(i for i, xf in enumerate(self.history) if f == xf)
-            self.playlist[:0] = self.history[idx:]
+            if self.is_auto_playlist:
+                del self.playlist[1:]
+            self.playlist.splice(0, self.history[idx:])
             del self.history[idx:]
             self.is_auto_playlist = False
+            self._locked_changed()
             if self.running:
                 self._locked_play()
+            return self.state_version
 
     @classmethod
     def tick(self):
@@ -675,11 +2191,13 @@ class ListManager(object):
                 ret = self.player.poll()
                 if not(ret is None):
                     log("player executable stopped")
+                    self.player_exited_at = time.time()
                     ok = not(self.started_at) or ((time.time() - self.started_at) > MinAcceptedPlayTime)
                     if ok:
                         self.fail_count = 0
                     else:
                         self.fail_count += 1
+                        Metrics.inc("kjukebox_player_failures_total")
                         log("WARNING: player exited suspiciously quickly (%d in a row)" % self.fail_count)
                         if self.fail_count >= MaxUnsuccessfulPlays:
                             log("WARNING: playback failed suspiciously often, stopping", True)
@@ -697,6 +2215,843 @@ class ListManager(object):
 
 ################################################################################
 
+class Future(object):
+    # result of a command executed by the engine thread
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+    def set(self, result=None, exc_info=None):
+        self.result = result
+        self.exc_info = exc_info
+        self.event.set()
+
+    def wait(self):
+        self.event.wait()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+class Engine(object):
+    # optional single-writer mode: one thread executes all ListManager
+    # commands from a queue, so the lock is never contended, and the lists
+    # the web interface polls are answered from snapshots that are published
+    # after each change, so they don't wait for slow commands like rescans
+    thread = None
+    queue = Queue.Queue()
+    published = {}
+    published_version = None
+    readers = {
+        "playlist": lambda: ListManager.get_list_body("playlist"),
+        "playlist.deflate": lambda: ListManager.get_list_body("playlist", True),
+        "history": lambda: ListManager.get_list_body("history"),
+        "history.deflate": lambda: ListManager.get_list_body("history", True),
+        "tracklists": ListManager.get_tracklists,
+    }
+
+    @classmethod
+    def start(self):
+        self._publish()
+        self.thread = threading.Thread(target=self._run, name="Engine")
+        self.thread.daemon = True
+        self.thread.start()
+
+    @classmethod
+    def stop(self):
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    @classmethod
+    def call(self, func, *args):
+        # runs func(*args) in the engine thread and waits for the result;
+        # without an engine, runs it directly
+        if not(self.thread) or (threading.current_thread() is self.thread):
+            return func(*args)
+        future = Future()
+        self.queue.put((func, args, future, time.time()))
+        return future.wait()
+
+    @classmethod
+    def read(self, name):
+        if self.thread:
+            return self.published[name]
+        return self.readers[name]()
+
+    @classmethod
+    def _publish(self):
+        self.published = dict((name, func()) for name, func in self.readers.iteritems())
+        self.published_version = (ListManager.state_version, ListManager.scan_tag)
+
+    @classmethod
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            func, args, future, queued_at = item
+            Metrics.observe("kjukebox_engine_queue_seconds", time.time() - queued_at)
+            try:
+                future.set(Debug.run(func, *args))
+            except Exception:
+                future.set(exc_info=sys.exc_info())
+            try:
+                if (ListManager.state_version, ListManager.scan_tag) != self.published_version:
+                    self._publish()
+            except Exception, e:
+                # readers fall back to the last snapshot; keep serving commands
+                log("ERROR: engine failed to publish snapshots - %s" % e, True)
+
+################################################################################
+
+class WorkerPool(object):
+    # priority queue served by a fixed number of daemon threads
+    def __init__(self, name, func, threads=1):
+        self.func = func
+        self.queue = Queue.PriorityQueue()
+        self.counter = itertools.count()
+        self.threads = []
+        for i in xrange(max(1, threads)):
+            t = threading.Thread(target=self._worker, name="%s-%d" % (name, i))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def put(self, item, priority=1):
+        self.queue.put((priority, next(self.counter), item))
+
+    def stop(self):
+        # let the workers finish the current queue, then quit
+        for t in self.threads:
+            self.queue.put((sys.maxint, next(self.counter), None))
+        for t in self.threads:
+            t.join()
+        self.threads = []
+
+    def _worker(self):
+        while True:
+            priority, seq, item = self.queue.get()
+            if item is None:
+                return
+            try:
+                self.func(item)
+            except Exception, e:
+                log("ERROR: background job for %r failed - %s" % (item, e))
+
+def low_priority():
+    # preexec_fn for helper processes that shouldn't disturb playback
+    if sys.platform != "win32":
+        os.nice(19)
+
+def write_cache_file(filename, entries):
+    # atomically replaces a cache file of 'signature<tab>value' lines
+    with open(filename + ".tmp", "w") as f:
+        for sig, value in entries:
+            f.write("%s\t%s\n" % (sig, value))
+    if (sys.platform == "win32") and os.path.exists(filename):
+        os.unlink(filename)
+    os.rename(filename + ".tmp", filename)
+
+class FileCache(object):
+    # directory of files generated from media files, keyed by the source's
+    # path (relative to the content directory), size and mtime, and bounded
+    # in size by evicting the least recently used entries; the directory
+    # is only listed once, and the time of last use is kept in memory and
+    # only written back to the files' mtime now and then
+    def __init__(self, cachedir, maxsize, ext):
+        self.cachedir = os.path.abspath(cachedir)
+        self.maxsize = maxsize
+        self.ext = ext
+        self.mutex = threading.Lock()
+        if not os.path.isdir(self.cachedir):
+            os.makedirs(self.cachedir)
+        self.entries = {}  # file name -> [size, time of last use]
+        for name in os.listdir(self.cachedir):
+            if name.endswith(self.ext):
+                try:
+                    st = os.stat(os.path.join(self.cachedir, name))
+                except EnvironmentError:
+                    continue
+                self.entries[name] = [st.st_size, st.st_mtime]
+        self.total = sum(e[0] for e in self.entries.itervalues())
+        self.evict()
+
+    @staticmethod
+    def signature(path):
+        try:
+            st = os.stat(path)
+        except EnvironmentError:
+            return None
+        root = os.path.join(ListManager.root, '')
+        if path.startswith(root):
+            # so a cache can be filled on another host (with the files'
+            # modification times preserved when copying them)
+            path = path[len(root):].replace('\\', '/')
+        return "%s|%d|%d" % (path, st.st_size, int(st.st_mtime))
+
+    def name_for(self, sig):
+        return hashlib.sha1(sig).hexdigest() + self.ext
+
+    def path_for(self, sig):
+        return os.path.join(self.cachedir, self.name_for(sig))
+
+    def contains(self, sig):
+        with self.mutex:
+            return self.name_for(sig) in self.entries
+
+    def lookup(self, sig):
+        name = self.name_for(sig)
+        cached = os.path.join(self.cachedir, name)
+        now = time.time()
+        with self.mutex:
+            entry = self.entries.get(name)
+            if not entry:
+                return None
+            if (now - entry[1]) > CacheTouchInterval:
+                # keeps the order of use across restarts, without writing
+                # to the card on every access
+                try:
+                    os.utime(cached, None)
+                except EnvironmentError:
+                    self.total -= entry[0]
+                    del self.entries[name]
+                    return None
+            entry[1] = now
+        return cached
+
+    def store(self, temp, sig):
+        name = self.name_for(sig)
+        size = os.path.getsize(temp)
+        os.rename(temp, os.path.join(self.cachedir, name))
+        with self.mutex:
+            old = self.entries.get(name)
+            if old:
+                self.total -= old[0]
+            self.entries[name] = [size, time.time()]
+            self.total += size
+        self.evict()
+
+    def evict(self):
+        with self.mutex:
+            if self.total <= self.maxsize:
+                return
+            # leave some headroom, so that not every store() has to evict
+            target = int(self.maxsize * CacheEvictTarget)
+            for name, (size, used) in sorted(self.entries.iteritems(), key=lambda e: e[1][1]):
+                if self.total <= target:
+                    break
+                full = os.path.join(self.cachedir, name)
+                try:
+                    os.unlink(full)
+                    Metrics.inc("kjukebox_cache_evictions_total", cache=os.path.basename(self.cachedir))
+                except EnvironmentError:
+                    if os.path.exists(full):
+                        continue
+                del self.entries[name]
+                self.total -= size
+
+class Transcoder(object):
+    # converts files the player can't handle well into a size-bounded
+    # cache directory, using a small pool of low-priority processes
+    enabled = False
+    cache = None
+    pool = None
+    maxsize = DefaultTranscodeCacheSize * 1024 * 1024
+    jobs = DefaultTranscodeJobs
+    idle_only = False
+    cmdline = DefaultTranscodeCmd.split()
+    mutex = threading.Lock()
+    probed = {}
+    failed = set()
+    sync_pool = None
+    generation = itertools.count(1)
+    latest = 0
+
+    @classmethod
+    def start(self, cachedir):
+        self.cache = FileCache(cachedir, self.maxsize, ".mp4")
+        try:
+            with open(os.path.join(self.cache.cachedir, "probe.txt")) as f:
+                for line in f:
+                    sig, sep, ok = line.rstrip('\n').rpartition('\t')
+                    if sig:
+                        self.probed[sig] = (ok == "1")
+        except EnvironmentError:
+            pass
+        self.pool = WorkerPool("Transcoder", self._process, self.jobs)
+        self.sync_pool = WorkerPool("TranscoderSync", self._sync)
+        self.enabled = True
+
+    @classmethod
+    def stop(self):
+        if self.pool:
+            self.pool.stop()
+
+    @classmethod
+    def lookup(self, path):
+        if not(self.enabled) or (os.path.splitext(path)[-1].strip('.').lower() in AudioExts):
+            return None
+        sig = FileCache.signature(path)
+        return sig and self.cache.lookup(sig)
+
+    @classmethod
+    def schedule(self, paths, priority=1):
+        if self.enabled:
+            for path in paths:
+                self.pool.put(path, priority)
+
+    @classmethod
+    def sync(self, root, paths):
+        # paths relative to root = the whole library
+        if self.enabled:
+            self.latest = next(self.generation)
+            self.sync_pool.put((self.latest, root, paths))
+
+    @classmethod
+    def _sync(self, item):
+        # forgets the probe results of modified or deleted files
+        gen, root, paths = item
+        if gen != self.latest:
+            return  # the library has changed again in the meantime
+        sigs = set(filter(None, (FileCache.signature(os.path.join(root, path)) for path in paths)))
+        with self.mutex:
+            stale = [sig for sig in self.probed if not(sig in sigs)]
+            if not stale:
+                return
+            for sig in stale:
+                del self.probed[sig]
+            try:
+                write_cache_file(os.path.join(self.cache.cachedir, "probe.txt"), ((sig, int(ok)) for sig, ok in self.probed.iteritems()))
+            except EnvironmentError, e:
+                log("WARNING: failed to save media probe results - %s" % e)
+
+    @classmethod
+    def needs_transcode(self, path, sig):
+        with self.mutex:
+            if sig in self.probed:
+                return not self.probed[sig]
+        cmdline = [(path if (x == '$') else x) for x in TranscodeProbeCmd.split()]
+        try:
+            out, dummy = subprocess.Popen(cmdline, stdin=nulldev(), stdout=subprocess.PIPE, stderr=nulldev(), preexec_fn=low_priority).communicate()
+        except EnvironmentError, e:
+            log("WARNING: failed to run media probe - %s" % e)
+            return False
+        info = dict(line.strip().split('=', 1) for line in out.splitlines() if ('=' in line))
+        ok = True
+        if info.get("codec_name"):  # files without video are always fine
+            try:
+                num, sep, den = info.get("avg_frame_rate", "0/1").partition('/')
+                fps = float(num) / float(den or 1)
+            except (ValueError, ZeroDivisionError):
+                fps = 0.0
+            ok = (info["codec_name"] == TranscodeProfile["codec"]) \
+             and (int(info.get("width") or 0) <= TranscodeProfile["width"]) \
+             and (int(info.get("height") or 0) <= TranscodeProfile["height"]) \
+             and (fps <= TranscodeProfile["fps"])
+        with self.mutex:
+            self.probed[sig] = ok
+            try:
+                with open(os.path.join(self.cache.cachedir, "probe.txt"), "a") as f:
+                    f.write("%s\t%d\n" % (sig, ok))
+            except EnvironmentError:
+                pass
+        return not ok
+
+    @classmethod
+    def _process(self, path):
+        if os.path.splitext(path)[-1].strip('.').lower() in AudioExts:
+            return  # any video stream is just cover art
+        sig = FileCache.signature(path)
+        if not(sig) or (sig in self.failed) or self.cache.contains(sig):
+            return
+        if not self.needs_transcode(path, sig):
+            return
+        while self.idle_only and ListManager.player:
+            time.sleep(1.0)
+        self._transcode(path, sig)
+
+    @classmethod
+    def _transcode(self, path, sig):
+        temp = self.cache.path_for(sig) + ".part"
+        cmdline = [(path if (x == '$') else (temp if (x == '@') else x)) for x in self.cmdline]
+        log("transcoding '%s'" % path)
+        t0 = time.time()
+        try:
+            ret = subprocess.call(cmdline, stdin=nulldev(), stdout=nulldev(), stderr=nulldev(), preexec_fn=low_priority)
+        except EnvironmentError, e:
+            ret = e
+        if ret or not(os.path.exists(temp)):
+            log("WARNING: failed to transcode '%s' (%s)" % (path, ret))
+            Metrics.inc("kjukebox_transcode_failures_total")
+            self.failed.add(sig)
+            try:
+                os.unlink(temp)
+            except EnvironmentError:
+                pass
+            return
+        self.cache.store(temp, sig)
+        Metrics.observe("kjukebox_transcode_seconds", time.time() - t0)
+        log("transcoding of '%s' finished after %.1f seconds" % (path, time.time() - t0))
+
+class Thumbnailer(object):
+    # extracts small preview pictures (a video frame or the embedded cover
+    # art of audio files) on demand, in one low-priority background thread
+    enabled = False
+    cache = None
+    pool = None
+    mutex = threading.Lock()
+    pending = set()
+    failed = set()
+
+    @classmethod
+    def start(self, cachedir, maxsize):
+        self.cache = FileCache(cachedir, maxsize, ".jpg")
+        self.pool = WorkerPool("Thumbnailer", self._process)
+        self.enabled = True
+
+    @classmethod
+    def get(self, path):
+        # returns (cached file or None, still pending?)
+        sig = FileCache.signature(path)
+        if not sig:
+            return (None, False)
+        cached = self.cache.lookup(sig)
+        if cached:
+            return (cached, False)
+        with self.mutex:
+            if sig in self.failed:
+                return (None, False)
+            if not(sig in self.pending):
+                self.pending.add(sig)
+                self.pool.put((path, sig), -time.time())  # most recent requests first
+        return (None, True)
+
+    @classmethod
+    def _process(self, item):
+        path, sig = item
+        temp = self.cache.path_for(sig) + ".part"
+        ok = False
+        cmds = [ThumbnailCmd]
+        if not(os.path.splitext(path)[-1].strip('.').lower() in AudioExts):
+            cmds.insert(0, ThumbnailSeekCmd)  # short videos need the fallback
+        for cmd in cmds:
+            cmdline = [(path if (x == '$') else (temp if (x == '@') else x)) for x in cmd.split()]
+            try:
+                ok = not(subprocess.call(cmdline, stdin=nulldev(), stdout=nulldev(), stderr=nulldev(), preexec_fn=low_priority)) \
+                     and (os.path.getsize(temp) > 0)
+            except EnvironmentError:
+                ok = False
+            if ok:
+                break
+        with self.mutex:
+            self.pending.discard(sig)
+            if ok:
+                self.cache.store(temp, sig)
+            else:
+                self.failed.add(sig)
+                try:
+                    os.unlink(temp)
+                except EnvironmentError:
+                    pass
+
+class Loudness(object):
+    # measures the integrated loudness (EBU R128) of the files with ffmpeg,
+    # in a small pool of low-priority processes, so that the player can be
+    # told to bring each track to the same target level; after each library
+    # change, all files that haven't been measured yet are queued
+    enabled = False
+    cachefile = None
+    pool = None
+    sync_pool = None
+    jobs = DefaultLoudnessJobs
+    target = DefaultLoudnessTarget
+    mutex = threading.Lock()
+    measured = {}
+    queued = set()
+    generation = itertools.count(1)
+    latest = 0
+
+    @classmethod
+    def start(self, cachefile):
+        self.cachefile = cachefile
+        try:
+            with open(cachefile) as f:
+                for line in f:
+                    sig, sep, lufs = line.rstrip('\n').rpartition('\t')
+                    if sig:
+                        try:
+                            self.measured[sig] = float(lufs)
+                        except ValueError:
+                            self.measured[sig] = None  # failed before
+        except EnvironmentError:
+            pass
+        self.pool = WorkerPool("Loudness", self._process, self.jobs)
+        self.sync_pool = WorkerPool("LoudnessSync", self._sync)
+        self.enabled = True
+
+    @classmethod
+    def schedule(self, paths, priority=1):
+        if self.enabled:
+            for path in paths:
+                with self.mutex:
+                    if (path in self.queued) and (priority > 0):
+                        continue  # only jump the queue once more
+                    self.queued.add(path)
+                self.pool.put(path, priority)
+
+    @classmethod
+    def sync(self, root, paths):
+        # paths relative to root = the whole library
+        if self.enabled:
+            self.latest = next(self.generation)
+            self.sync_pool.put((self.latest, root, paths))
+
+    @staticmethod
+    def _format(lufs):
+        return "-" if (lufs is None) else ("%.2f" % lufs)
+
+    @classmethod
+    def _sync(self, item):
+        gen, root, paths = item
+        if gen != self.latest:
+            return  # the library has changed again in the meantime
+        sigs = {}
+        for path in paths:
+            path = os.path.join(root, path)
+            sig = FileCache.signature(path)
+            if sig:
+                sigs[sig] = path
+        with self.mutex:
+            todo = sorted(path for sig, path in sigs.iteritems() if not(sig in self.measured))
+            stale = [sig for sig in self.measured if not(sig in sigs)]
+            if stale:
+                # rewrite the cache file without modified or deleted files
+                for sig in stale:
+                    del self.measured[sig]
+                try:
+                    write_cache_file(self.cachefile, ((sig, self._format(lufs)) for sig, lufs in self.measured.iteritems()))
+                except EnvironmentError, e:
+                    log("WARNING: failed to save loudness cache - %s" % e)
+        self.schedule(todo)
+
+    @classmethod
+    def gain(self, path):
+        # in dB, or None if not known (yet)
+        if not self.enabled:
+            return None
+        sig = FileCache.signature(path)
+        with self.mutex:
+            lufs = self.measured.get(sig)
+        if (lufs is None) or (lufs < -70.0):  # unknown or silence
+            return None
+        return max(-MaxLoudnessGain, min(MaxLoudnessGain, self.target - lufs))
+
+    @classmethod
+    def _process(self, path):
+        sig = FileCache.signature(path)
+        with self.mutex:
+            self.queued.discard(path)
+            if not(sig) or (sig in self.measured):
+                return
+        cmdline = [(path if (x == '$') else x) for x in LoudnessCmd.split()]
+        t0 = time.time()
+        lufs = None
+        try:
+            out, err = subprocess.Popen(cmdline, stdin=nulldev(), stdout=nulldev(), stderr=subprocess.PIPE, preexec_fn=low_priority).communicate()
+            m = re.search(r'"input_i"\s*:\s*"(-?[\d.]+|-inf)"', err)
+            if m:
+                lufs = float(m.group(1))
+        except (EnvironmentError, ValueError), e:
+            log("WARNING: failed to run loudness analysis - %s" % e)
+        if lufs is None:
+            Metrics.inc("kjukebox_loudness_failures_total")
+        else:
+            Metrics.observe("kjukebox_loudness_seconds", time.time() - t0)
+        with self.mutex:
+            self.measured[sig] = lufs
+            try:
+                with open(self.cachefile, "a") as f:
+                    f.write("%s\t%s\n" % (sig, self._format(lufs)))
+            except EnvironmentError:
+                pass
+
+def fingerprint(path):
+    # file size plus a hash of some evenly spaced blocks; runs in a worker
+    # process, so it only returns data
+    try:
+        size = os.path.getsize(path)
+        if not size:
+            return (path, None)
+        h = hashlib.sha1(str(size))
+        with open(path, "rb") as f:
+            if size <= DedupeSamples * DedupeSampleSize:
+                h.update(f.read())
+            else:
+                step = (size - DedupeSampleSize) // (DedupeSamples - 1)
+                for i in xrange(DedupeSamples):
+                    f.seek(i * step)
+                    h.update(f.read(DedupeSampleSize))
+        return (path, "%d:%s" % (size, h.hexdigest()))
+    except EnvironmentError:
+        return (path, None)
+
+class Deduplicator(object):
+    # finds files with identical content under different paths; after each
+    # library change, all files are fingerprinted by a pool of low-priority
+    # processes, with results cached by path, size and mtime
+    enabled = False
+    cachefile = None
+    jobs = DefaultDedupeJobs
+    pool = None
+    cache = {}
+    generation = itertools.count(1)
+    latest = 0
+
+    @classmethod
+    def start(self, cachefile):
+        self.cachefile = cachefile
+        try:
+            with open(cachefile) as f:
+                for line in f:
+                    sig, sep, fp = line.rstrip('\n').rpartition('\t')
+                    if sig:
+                        self.cache[sig] = fp
+        except EnvironmentError:
+            pass
+        self.pool = WorkerPool("Deduplicator", self._process)
+        self.enabled = True
+
+    @classmethod
+    def schedule(self, root, files):
+        # files = list of (key, path relative to root)
+        if self.enabled:
+            self.latest = next(self.generation)
+            self.pool.put((self.latest, root, files))
+
+    @classmethod
+    def _hash_all(self, paths):
+        pool = None
+        if multiprocessing and (self.jobs > 0) and paths:
+            try:
+                pool = multiprocessing.Pool(self.jobs, low_priority)
+            except (EnvironmentError, ImportError), e:
+                log("WARNING: can not start worker processes for duplicate detection - %s" % e)
+        if not pool:
+            for result in itertools.imap(fingerprint, paths):
+                yield result
+            return
+        try:
+            for result in pool.imap_unordered(fingerprint, paths, 16):
+                yield result
+        finally:
+            pool.close()
+            pool.join()
+
+    @classmethod
+    def _process(self, item):
+        gen, root, files = item
+        if gen != self.latest:
+            return  # the library has changed again in the meantime
+        t0 = time.time()
+        sigs = {}
+        for key, path in files:
+            sig = FileCache.signature(os.path.join(root, path))
+            if sig:
+                sigs[os.path.join(root, path)] = sig
+        todo = [path for path, sig in sigs.iteritems() if not(sig in self.cache)]
+        for path, fp in self._hash_all(todo):
+            self.cache[sigs[path]] = fp or ""
+            Metrics.inc("kjukebox_dedupe_files_hashed_total")
+        if todo:
+            # rewrite the cache file, dropping entries for stale signatures
+            self.cache = dict((sig, self.cache[sig]) for sig in sigs.itervalues())
+            try:
+                write_cache_file(self.cachefile, self.cache.iteritems())
+            except EnvironmentError, e:
+                log("WARNING: failed to save fingerprint cache - %s" % e)
+        groups = collections.defaultdict(list)
+        for key, path in files:
+            fp = self.cache.get(sigs.get(os.path.join(root, path)))
+            if fp:
+                groups[fp].append(key)
+        groups = [sorted(keys) for keys in groups.itervalues() if len(keys) > 1]
+        if todo or groups:
+            log("duplicate detection finished after %.1f seconds: %d file(s) fingerprinted, %d set(s) of duplicates" % (time.time() - t0, len(todo), len(groups)))
+        Engine.call(ListManager.set_duplicates, groups)
+
+################################################################################
+
+class Database(object):
+    # optional SQLite storage for the library, play events, play counts,
+    # history and playlist; all writes go through a single background
+    # thread that groups them into transactions, and every reading thread
+    # gets its own connection
+    enabled = False
+    filename = None
+    synced = False
+    queue = Queue.Queue()
+    local = threading.local()
+    writer = None
+    schema = """
+        CREATE TABLE IF NOT EXISTS tracks (
+            key TEXT PRIMARY KEY, path TEXT, present INTEGER NOT NULL DEFAULT 0,
+            added REAL, playcount INTEGER NOT NULL DEFAULT 0);
+        CREATE INDEX IF NOT EXISTS tracks_playcount ON tracks (present, playcount);
+        CREATE TABLE IF NOT EXISTS plays (
+            id INTEGER PRIMARY KEY, key TEXT NOT NULL, started REAL NOT NULL,
+            duration REAL, counted INTEGER NOT NULL);
+        CREATE INDEX IF NOT EXISTS plays_key ON plays (key);
+        CREATE INDEX IF NOT EXISTS plays_started ON plays (started);
+        CREATE TABLE IF NOT EXISTS queue (
+            list TEXT NOT NULL, pos INTEGER NOT NULL, key TEXT NOT NULL,
+            PRIMARY KEY (list, pos));
+    """
+
+    @classmethod
+    def open(self, filename):
+        if not sqlite3:
+            raise EnvironmentError("Python was built without SQLite support")
+        self.filename = os.path.abspath(filename)
+        try:
+            conn = self.connect()
+            conn.executescript(self.schema)
+            conn.commit()
+        except sqlite3.Error, e:
+            raise EnvironmentError(str(e))
+        self.writer = threading.Thread(target=self._writer, name="Database")
+        self.writer.daemon = True
+        self.writer.start()
+        self.enabled = True
+
+    @classmethod
+    def close(self):
+        if self.writer:
+            self.queue.put(None)
+            self.writer.join()
+            self.writer = None
+
+    @classmethod
+    def connect(self):
+        conn = getattr(self.local, "conn", None)
+        if not conn:
+            conn = self.local.conn = sqlite3.connect(self.filename, timeout=30.0)
+            conn.text_factory = str  # keys and paths are byte strings
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @classmethod
+    def write(self, *statements):
+        # (sql, tuple) runs a statement once, (sql, list of tuples) for each
+        # row; the statements of one call always share a transaction
+        self.queue.put(statements)
+
+    @classmethod
+    def flush(self):
+        self.queue.join()
+
+    @classmethod
+    def _writer(self):
+        conn = self.connect()
+        while True:
+            batch = [self.queue.get()]
+            while (batch[-1] is not None) and (len(batch) < DatabaseBatchSize):
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            try:
+                with conn:
+                    for statements in filter(None, batch):
+                        for sql, args in statements:
+                            if isinstance(args, list):
+                                conn.executemany(sql, args)
+                            else:
+                                conn.execute(sql, args)
+            except sqlite3.Error, e:
+                log("ERROR: database write failed - %s" % e)
+            for item in batch:
+                self.queue.task_done()
+            if batch[-1] is None:
+                return
+
+    @classmethod
+    def sync_library(self, new_files, deleted_files):
+        statements = []
+        if not self.synced:
+            # files may have vanished while we weren't running
+            statements.append(("UPDATE tracks SET present=0", ()))
+            self.synced = True
+        now = time.time()
+        statements += [
+            ("INSERT OR IGNORE INTO tracks (key, added) VALUES (?, ?)", [(f.key, now) for f in new_files]),
+            ("UPDATE tracks SET path=?, present=1 WHERE key=?", [(f.path, f.key) for f in new_files]),
+            ("UPDATE tracks SET present=0 WHERE key=?", [(f.key,) for f in deleted_files]),
+        ]
+        self.write(*statements)
+
+    @classmethod
+    def record_play(self, key, started, duration, counted):
+        statements = [("INSERT INTO plays (key, started, duration, counted) VALUES (?, ?, ?, ?)", (key, started, duration, int(counted)))]
+        if counted:
+            statements += [
+                ("INSERT OR IGNORE INTO tracks (key) VALUES (?)", (key,)),
+                ("UPDATE tracks SET playcount=playcount+1 WHERE key=?", (key,)),
+            ]
+        self.write(*statements)
+
+    @classmethod
+    def save_queue(self, history, playlist):
+        self.write(
+            ("DELETE FROM queue", ()),
+            ("INSERT INTO queue (list, pos, key) VALUES (?, ?, ?)",
+                [("history", i, f.key) for i, f in enumerate(history)] +
+                [("playlist", i, f.key) for i, f in enumerate(playlist)]))
+
+    @classmethod
+    def import_state(self, history, playlist, playcounts):
+        self.write(
+            ("UPDATE tracks SET playcount=0", ()),
+            ("INSERT OR IGNORE INTO tracks (key) VALUES (?)", [(k,) for k in playcounts]),
+            ("UPDATE tracks SET playcount=? WHERE key=?", [(c, k) for k, c in playcounts.iteritems()]))
+        self.save_queue(history, playlist)
+
+    @classmethod
+    def has_state(self):
+        return bool(self.connect().execute(
+            "SELECT EXISTS (SELECT 1 FROM queue) OR EXISTS (SELECT 1 FROM tracks WHERE playcount > 0)").fetchone()[0])
+
+    @classmethod
+    def load_state(self):
+        # returns lists of history and playlist keys and a dict of play counts
+        conn = self.connect()
+        queue = {"history": [], "playlist": []}
+        for name, key in conn.execute("SELECT list, key FROM queue ORDER BY list, pos"):
+            queue.setdefault(name, []).append(key)
+        playcounts = dict(conn.execute("SELECT key, playcount FROM tracks WHERE playcount > 0"))
+        return queue["history"], queue["playlist"], playcounts
+
+    @classmethod
+    def first_queued(self):
+        row = self.connect().execute("SELECT key FROM queue WHERE list='playlist' ORDER BY pos LIMIT 1").fetchone()
+        return row[0] if row else None
+
+    @classmethod
+    def most_played(self, count, least=False):
+        return self.connect().execute(
+            "SELECT key, playcount FROM tracks WHERE present=1 ORDER BY playcount %s, key LIMIT ?" % ("ASC" if least else "DESC"),
+            (count,)).fetchall()
+
+    @classmethod
+    def plays_per_hour(self, since=0):
+        return self.connect().execute(
+            "SELECT CAST(strftime('%H', started, 'unixepoch', 'localtime') AS INTEGER) AS hour, COUNT(*) "
+            "FROM plays WHERE counted=1 AND started >= ? GROUP BY hour ORDER BY hour", (since,)).fetchall()
+
+################################################################################
+
 StaticHTMLContent = {
 
 "": ("text/html; charset=utf-8", r'''<!DOCTYPE html>
@@ -713,26 +3068,53 @@ style="background-position-x:-140px;" onClick="setMode('history')" title="show h
 style="background-position-x:-210px;" onClick="sendCmd('/prev')" title="go to previous track"></div><div
 style="background-position-x:-280px;" onClick="sendCmd('/play')" title="start playback or replay current track"></div><div
 style="background-position-x:-350px;" onClick="sendCmd('/stop')" title="stop playback"></div><div
-style="background-position-x:-420px;" onClick="sendCmd('/next')" title="go to next track"></div></div><div
+style="background-position-x:-420px;" onClick="sendCmd('/next')" title="go to next track"></div><div
+style="background-position-x:-490px;" onClick="setMode('folders')" title="browse folders"></div></div><div
 id="main"><input id="search" type="text" onchange="updateSearch()" oninput="updateSearch()"></input><ul
-id="list"></ul></div></body></html>
+id="list"></ul></div><div id="selbar"></div></body></html>
 '''),
 
 "script.js": ("text/javascript", r'''
 var g_currentMode;
+var g_selection = null;
+var g_drag = null;
+var g_thumbs = null;
+var g_version = null;
+var g_listRequest = null;
 var menuItems = {
     "browse": [
         { cmd:"/playnow?",  icon:"play",  text:"play now" },
         { cmd:"/insert?",   icon:"front", text:"play next" },
-        { cmd:"/add?",      icon:"add",   text:"append to playlist" }
+        { cmd:"/add?",      icon:"add",   text:"append to playlist" },
+        { cmd:"#select",    icon:"add",   text:"select multiple tracks" }
     ],
     "playlist": [
         { cmd:"/playnow?",  icon:"play",  text:"play now" },
         { cmd:"/insert?",   icon:"front", text:"play next" },
-        { cmd:"/remove?",   icon:"del",   text:"remove from playlist" }
+        { cmd:"/remove?",   icon:"del",   text:"remove from playlist" },
+        { cmd:"#select",    icon:"add",   text:"select multiple tracks" }
     ],
     "history": [
         { cmd:"/rollback?", icon:"front", text:"rewind to here" },
+    ],
+    "folders": [
+        { cmd:"/playnow?",  icon:"play",  text:"play now" },
+        { cmd:"/insert?",   icon:"front", text:"play next" },
+        { cmd:"/add?",      icon:"add",   text:"append to playlist" }
+    ]
+};
+var folderActions = [
+    { cmd:"/addfolder?",     text:"append all tracks to playlist" },
+    { cmd:"/shufflefolder?", text:"append all tracks in random order" }
+];
+var selectionActions = {
+    "browse": [
+        { op:"insert", text:"play next", reverse:true },
+        { op:"add",    text:"append" }
+    ],
+    "playlist": [
+        { op:"insert", text:"play next", reverse:true },
+        { op:"remove", text:"remove" }
     ]
 };
 
@@ -765,12 +3147,110 @@ function makeNode(text, action=null, classes=null) {
     return node;
 }
 
-function sendCmd(url) {
+function sendCmd(url, update=null) {
+    // if the effect of the command can be predicted, it's applied to the
+    // list right away; the list is only reloaded if the state version sent
+    // back by the server doesn't match the prediction
+    var mode = g_currentMode;
+    var expected = null;
+    if (update && (g_version != null)) {
+        update();
+        expected = ++g_version;
+    }
     var req = new XMLHttpRequest();
-    req.open("GET", url, false);
+    req.onreadystatechange = function() {
+        if ((this.readyState != 4) || (mode != g_currentMode)) { return; }
+        if ((expected != null) && (this.status == 200) && (parseInt(this.responseText) == expected)) { return; }
+        if ((mode == "playlist") || (mode == "history")) {
+            setMode(mode);
+        }
+    }
+    req.open("GET", url);
     req.send();
-    if (g_currentMode != "browse") {
-        setMode(g_currentMode);
+}
+
+function sendBatch(ops) {
+    var mode = g_currentMode;
+    var req = new XMLHttpRequest();
+    req.onreadystatechange = function() {
+        if ((this.readyState == 4) && (mode == g_currentMode) && (mode != "browse")) {
+            setMode(mode);
+        }
+    }
+    req.open("POST", "/batch");
+    req.setRequestHeader("Content-Type", "text/plain");
+    req.send(ops.join("\n"));
+}
+
+function predictCmd(cmd, node) {
+    // returns a function that applies a command's effect on the playlist
+    // view, or null if it depends on more than the list itself
+    var list = document.getElementById("list");
+    if ((g_currentMode != "playlist") || !node) { return null; }
+    if (cmd == "/remove?") {
+        return function() { list.removeChild(node); };
+    }
+    if (cmd == "/insert?") {
+        return function() { list.insertBefore(node, playlistItems()[0]); };
+    }
+    return null;
+}
+
+function startSelection(node) {
+    g_selection = [];
+    toggleSelection(node);
+}
+
+function endSelection() {
+    g_selection = null;
+    var items = document.getElementById("list").getElementsByClassName("checked");
+    while (items.length) {
+        items[0].classList.remove("checked");
+    }
+    updateSelectionBar();
+}
+
+function toggleSelection(node) {
+    var iid = node.getAttribute('data-id');
+    var idx = g_selection.indexOf(iid);
+    if (idx < 0) {
+        g_selection.push(iid);
+        node.classList.add("checked");
+    } else {
+        g_selection.splice(idx, 1);
+        node.classList.remove("checked");
+    }
+    updateSelectionBar();
+}
+
+function onSelectionAction(ev) {
+    var action = ev.target.action;
+    var ids = g_selection.slice();
+    if (action.reverse) { ids.reverse(); }
+    endSelection();
+    sendBatch(ids.map(function(iid) { return action.op + " " + iid; }));
+}
+
+function updateSelectionBar() {
+    var bar = document.getElementById("selbar");
+    while (bar.hasChildNodes()) {
+        bar.removeChild(bar.firstChild);
+    }
+    setVisible(bar, g_selection != null);
+    if (g_selection == null) { return; }
+    var actions = (selectionActions[g_currentMode] || []).concat([{ text:"cancel" }]);
+    bar.appendChild(document.createTextNode(g_selection.length + " selected"));
+    for (var i = 0;  i < actions.length;  i++) {
+        var button = document.createElement("span");
+        button.appendChild(document.createTextNode(actions[i].text));
+        if (actions[i].op) {
+            button.action = actions[i];
+            if (g_selection.length) { button.addEventListener('click', onSelectionAction); }
+            else { button.className = "disabled"; }
+        } else {
+            button.addEventListener('click', endSelection);
+        }
+        bar.appendChild(button);
     }
 }
 
@@ -793,14 +3273,85 @@ function hideMenu() {
 
 function onMenuItemClick(ev) {
     var node = ev.target;
-    sendCmd(node.getAttribute('data-cmd'));
-    if (g_currentMode == "browse") {
-        hideMenu();
+    var cmd = node.getAttribute('data-cmd');
+    if (cmd.substr(0, 7) == "#select") {
+        startSelection(hideMenu());
+        return;
+    }
+    sendCmd(cmd, predictCmd(cmd.substr(0, cmd.indexOf("?") + 1), hideMenu()));
+}
+
+function setDepth(node, depth) {
+    node.setAttribute('data-depth', depth);
+    node.style.paddingLeft = (4 + 20 * depth) + "px";
+}
+
+function collapseFolder(node) {
+    var depth = parseInt(node.getAttribute('data-depth'));
+    var next = node.nextSibling;
+    while (next && !(parseInt(next.getAttribute('data-depth')) <= depth)) {
+        var curr = next;
+        next = curr.nextSibling;
+        curr.parentNode.removeChild(curr);
+    }
+    node.classList.remove("open");
+}
+
+function onFolderClick(ev) {
+    var node = ev.target;
+    hideMenu();
+    if (node.classList.contains("open")) {
+        return collapseFolder(node);
+    }
+    node.classList.add("open");
+    var path = node.getAttribute('data-path');
+    var req = new XMLHttpRequest();
+    req.onreadystatechange = function() {
+        if ((this.readyState == 4) && (this.status == 200)) {
+            populateFolder(this.responseText, node);
+        }
+    }
+    req.open("GET", "/folders?" + encodeURIComponent(path));
+    req.send();
+}
+
+function populateFolder(data, parent) {
+    var list = document.getElementById("list");
+    var next = parent ? parent.nextSibling : null;
+    var depth = parent ? (parseInt(parent.getAttribute('data-depth')) + 1) : 0;
+    if (parent) {
+        folderActions.forEach(function(item) {
+            var node = makeNode(item.text, onMenuItemClick, "faction");
+            node.setAttribute('data-cmd', item.cmd + encodeURIComponent(parent.getAttribute('data-path')));
+            setDepth(node, depth);
+            list.insertBefore(node, next);
+        })
     }
+    data.split('\n').forEach(function(rawitem) {
+        var item = rawitem.split('\t');
+        if ((item.length < 2) || !item[0] || !item[1]) { return; }
+        var node;
+        if (item[0].substr(0, 1) == "/") {
+            node = makeNode(item[1] + " (" + item[2] + ")", onFolderClick, "folder");
+            node.setAttribute('data-path', item[0].substr(1));
+        } else {
+            node = makeNode(item[1], onListItemClick);
+            node.setAttribute('data-id', item[0]);
+            addThumbnail(node);
+        }
+        setDepth(node, depth);
+        list.insertBefore(node, next);
+    })
 }
 
 function onListItemClick(ev) {
     var node = ev.target;
+    if (g_selection != null) {
+        if (!node.classList.contains("playing") && !node.classList.contains("autoplay")) {
+            toggleSelection(node);
+        }
+        return;
+    }
     if (hideMenu() == node) {
         // when clicking on an already open menu again, hide it
         return;
@@ -826,19 +3377,126 @@ function onListItemClick(ev) {
     }
 }
 
+function addThumbnail(node) {
+    if (g_thumbs) { g_thumbs.observe(node); }
+}
+
+function onThumbnailVisible(entries, observer) {
+    entries.forEach(function(entry) {
+        if (!entry.isIntersecting) { return; }
+        observer.unobserve(entry.target);
+        var img = document.createElement("img");
+        img.className = "thumb";
+        img.setAttribute('data-tries', 0);
+        img.addEventListener('load', onThumbnailLoad);
+        img.addEventListener('error', function() { img.remove(); });
+        img.src = "/thumb?" + entry.target.getAttribute('data-id');
+        entry.target.insertBefore(img, entry.target.firstChild);
+    })
+}
+
+function onThumbnailLoad(ev) {
+    // a 1x1 placeholder means that the thumbnail is still being generated
+    var img = ev.target;
+    if (img.naturalWidth > 1) { return; }
+    var tries = parseInt(img.getAttribute('data-tries')) + 1;
+    if (tries > 5) { img.remove();  return; }
+    img.setAttribute('data-tries', tries);
+    setTimeout(function() {
+        if (img.parentNode) {
+            img.src = "/thumb?" + img.parentNode.getAttribute('data-id') + "&r=" + tries;
+        }
+    }, 3000);
+}
+
+function addDragHandle(node) {
+    var handle = document.createElement("span");
+    handle.className = "handle";
+    handle.appendChild(document.createTextNode("\u2261"));
+    handle.addEventListener('pointerdown', onDragStart);
+    handle.addEventListener('click', function(ev) { ev.stopPropagation(); });
+    node.appendChild(handle);
+}
+
+function playlistItems() {
+    var items = [];
+    var nodes = document.getElementById("list").children;
+    for (var i = 0;  i < nodes.length;  i++) {
+        if (!nodes[i].classList.contains("playing") && !nodes[i].classList.contains("menu")) {
+            items.push(nodes[i]);
+        }
+    }
+    return items;
+}
+
+function dropTarget(ev) {
+    var node = document.elementFromPoint(ev.clientX, ev.clientY);
+    while (node && (node.tagName != "LI")) { node = node.parentNode; }
+    if (!node || node.classList.contains("playing") || node.classList.contains("menu")) { return null; }
+    return node;
+}
+
+function onDragStart(ev) {
+    ev.preventDefault();
+    hideMenu();
+    var handle = ev.target;
+    g_drag = { node: handle.parentNode, target: null };
+    g_drag.node.classList.add("dragging");
+    handle.setPointerCapture(ev.pointerId);
+    handle.addEventListener('pointermove', onDragMove);
+    handle.addEventListener('pointerup', onDragEnd);
+    handle.addEventListener('pointercancel', onDragEnd);
+}
+
+function onDragMove(ev) {
+    var target = dropTarget(ev);
+    if (g_drag.target) { g_drag.target.classList.remove("droptarget"); }
+    g_drag.target = target;
+    if (target && (target != g_drag.node)) { target.classList.add("droptarget"); }
+}
+
+function onDragEnd(ev) {
+    var handle = ev.target;
+    handle.removeEventListener('pointermove', onDragMove);
+    handle.removeEventListener('pointerup', onDragEnd);
+    handle.removeEventListener('pointercancel', onDragEnd);
+    var drag = g_drag;
+    g_drag = null;
+    drag.node.classList.remove("dragging");
+    if (drag.target) { drag.target.classList.remove("droptarget"); }
+    if ((ev.type == "pointerup") && drag.target && (drag.target != drag.node)) {
+        var items = playlistItems();
+        var pos = items.indexOf(drag.target);
+        var down = (items.indexOf(drag.node) < pos);
+        sendCmd("/move?id=" + drag.node.getAttribute('data-id') + "&pos=" + pos, function() {
+            drag.node.parentNode.insertBefore(drag.node, down ? drag.target.nextSibling : drag.target);
+        });
+    }
+}
+
 function populateList(data) {
     var list = document.getElementById("list");
     var node = null;
+    var dir = "";
     data.split('\n').forEach(function(rawitem) {
         if (!rawitem) { return; }
         var item = rawitem.split('\t');
+        if (item[0].substr(0, 1) == "/") {
+            // compact format: switch to another directory
+            dir = dir.substr(0, parseInt(item[0].substr(1))) + (item[1] || "");
+            return;
+        }
         if ((item.length < 2) || !item[0] || !item[1]) { return; }
         var iid = item[0];
         var cls = null;
         if (iid.substr(0, 1) == "+") { cls = "playing";  iid = iid.substr(1); }
         if (iid.substr(0, 1) == "-") { cls = "autoplay"; iid = iid.substr(1); }
-        node = makeNode(item[1], onListItemClick, cls);
+        node = makeNode(dir ? (dir + "\xa0\u25ba " + item[1]) : item[1], onListItemClick, cls);
         node.setAttribute('data-id', iid);
+        if ((g_currentMode == "playlist") && !cls) {
+            addDragHandle(node);
+        }
+        addThumbnail(node);
         list.appendChild(node);
     })
     if (g_currentMode == "browse") {
@@ -854,14 +3512,19 @@ function setMode(mode) {
     var listEvent = null;
     var searchBox = document.getElementById("search");
     var searchVisible = false;
-    if ((mode != "history") && (mode != "playlist")) {
+    if (mode == "folders") {
+        listURL = "/folders";
+    } else if ((mode != "history") && (mode != "playlist")) {
         mode = "browse";
-        listURL = "/tracklist";
+        listURL = "/tracklist?compact";
         searchVisible = true;
         searchBox.value = "";
     }
     g_currentMode = mode;
+    g_version = null;
     window.location.hash = mode;
+    g_selection = null;
+    updateSelectionBar();
     setVisible(searchBox, searchVisible);
     
     // clear and reload list
@@ -869,10 +3532,20 @@ function setMode(mode) {
     while (list.hasChildNodes()) {
         list.removeChild(list.firstChild);
     }
-    var req = new XMLHttpRequest();
+    if (g_listRequest) {
+        g_listRequest.abort();
+    }
+    var req = g_listRequest = new XMLHttpRequest();
     req.onreadystatechange = function() {
         if ((this.readyState == 4) && (this.status == 200)) {
-            populateList(this.responseText);
+            g_listRequest = null;
+            var version = this.getResponseHeader("X-State-Version");
+            g_version = version ? parseInt(version) : null;
+            if (mode == "folders") {
+                populateFolder(this.responseText, null);
+            } else {
+                populateList(this.responseText);
+            }
         }
     }
     req.open("GET", listURL);
@@ -883,6 +3556,17 @@ function init() {
     var mode = window.location.hash.toLowerCase();
     if (mode.substr(0, 1) == '#') { mode = mode.substr(1); }
     setMode(mode);
+    if (window.IntersectionObserver) {
+        var req = new XMLHttpRequest();
+        req.onreadystatechange = function() {
+            if ((this.readyState == 4) && (this.status == 200)) {
+                g_thumbs = new IntersectionObserver(onThumbnailVisible, { rootMargin: "200px" });
+                document.querySelectorAll("#list li[data-id]").forEach(addThumbnail);
+            }
+        }
+        req.open("GET", "/thumb");
+        req.send();
+    }
 }
 '''),
 
@@ -926,7 +3610,7 @@ input {
     background-color: #ffe;
 }
 #main {
-    margin: 85px 0 0 0;
+    margin: 85px 0 48px 0;
     padding: 0;
 }
 #list {
@@ -949,6 +3633,19 @@ li.menu {
     background: url(icons.svg) no-repeat -9999px -9999px;
     background-color: #def;
 }
+li.faction {
+    font-style: italic;
+    background-color: #eef4fa;
+}
+li.folder {
+    font-weight: bold;
+}
+li.folder:before {
+    content: "\25b8\a0";
+}
+li.folder.open:before {
+    content: "\25be\a0";
+}
 li.iplay  { background-position: -400px -160px; }
 li.iadd   { background-position: -300px -190px; }
 li.ifront { background-position: -200px -220px; }
@@ -956,7 +3653,7 @@ li.idel   { background-position: -100px -250px; }
 li:not(.selected):hover {
     background-color: #f0f8ff;
 }
-li.menu:hover {
+li.menu:hover, li.faction:hover {
     background-color: #cdf;
 }
 li.playing {
@@ -965,7 +3662,53 @@ li.playing {
 li.autoplay {
     color: #888;
 }
-@media screen and (max-width: 520px) {
+li.checked {
+    background-color: #fe9;
+}
+li .handle {
+    float: right;
+    padding: 0 8px 0 16px;
+    color: #888;
+    cursor: grab;
+    touch-action: none;
+}
+li img.thumb {
+    display: inline-block;
+    vertical-align: middle;
+    width: 42px;
+    height: 24px;
+    margin: -4px 8px -4px 0;
+    object-fit: cover;
+    pointer-events: none;
+}
+li.dragging {
+    background-color: #def;
+}
+li.droptarget {
+    border-top: solid 3px #48c;
+}
+#selbar {
+    position: fixed;
+    bottom: 0;
+    width: 100%;
+    padding: 8px 0 8px 0;
+    text-align: center;
+    background-color: #ccc;
+    border-top: solid 1px #888;
+}
+#selbar > span {
+    display: inline-block;
+    margin: 0 0 0 12px;
+    padding: 4px 8px 4px 8px;
+    background-color: white;
+    border: solid 1px #888;
+    cursor: pointer;
+}
+#selbar > span.disabled {
+    color: #aaa;
+    cursor: default;
+}
+@media screen and (max-width: 592px) {
     #buttons {
         height: 48px;
     }
@@ -978,7 +3721,7 @@ li.autoplay {
         margin-top: 65px;
     }
 }
-@media screen and (max-width: 408px) {
+@media screen and (max-width: 464px) {
     #buttons {
         height: 32px;
     }
@@ -994,7 +3737,7 @@ li.autoplay {
 '''),
 
 "icons.svg": ("image/svg+xml", r'''<?xml version="1.0" encoding="UTF-8" standalone="no"?>
-<svg xmlns="http://www.w3.org/2000/svg" width="490" height="310">
+<svg xmlns="http://www.w3.org/2000/svg" width="560" height="310">
 <defs>
 <style type="text/css">
 * { stroke:none; fill-opacity:0.75; fill:white; }
@@ -1008,6 +3751,7 @@ li.autoplay {
 <g id="b4"><use href="#c" /><path d="m 46,32 -24,-16 v 32 l 24,-16 z" /></g>
 <g id="b5"><use href="#c" /><path d="m 20,20 v 24 h 24 v -24 z" /></g>
 <g id="b6"><use href="#c" /><path d="m 12,20 v 24 l 18,-12 z m 18,12 v 12 l 18,-12 -18,-12 z m 18,0 v 12 h 5 v -24 h -5 z" /></g>
+<g id="b7"><use href="#c" /><path d="m 14,18 c -1.108,0 -2,0.892 -2,2 v 24 c 0,1.108 0.892,2 2,2 h 36 c 1.108,0 2,-0.892 2,-2 v -20 c 0,-1.108 -0.892,-2 -2,-2 h -18 l -4,-4 z" /></g>
 </defs>
 <use href="#b0" transform="translate(  0 0)" />
 <use href="#b0" transform="translate(  0 70) scale(0.75)" />
@@ -1030,6 +3774,9 @@ li.autoplay {
 <use href="#b6" transform="translate(420 0)" />
 <use href="#b6" transform="translate(420 70) scale(0.75)" />
 <use href="#b6" transform="translate(420 120) scale(0.5)" />
+<use href="#b7" transform="translate(490 0)" />
+<use href="#b7" transform="translate(490 70) scale(0.75)" />
+<use href="#b7" transform="translate(490 120) scale(0.5)" />
 <g id="menu" transform="translate(12 6)">
 <path transform="translate(400 160)" d="M 4,16 V 0 l 10,8 z" />
 <path transform="translate(300 190)" d="M 6,1 V 6 H 1 v 4 h 5 v 5 h 4 v -5 h 5 V 6 H 10 V 1 Z" />
@@ -1047,9 +3794,146 @@ def mod_gzip():
 
 ################################################################################
 
+def _libc_sendfile():
+    if not(ctypes) or not(sys.platform.startswith("linux")):
+        return None
+    try:
+        func = ctypes.CDLL(None, use_errno=True).sendfile64
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    func.restype = ctypes.c_ssize_t
+    return func
+libc_sendfile = _libc_sendfile()
+
+def sendfile(sock, fd, offset, count):
+    # copies a part of a file to a socket without going through userspace;
+    # Python 2 has no os.sendfile(), so the C library is called directly
+    offset = ctypes.c_int64(offset)
+    while count > 0:
+        n = libc_sendfile(sock.fileno(), fd, ctypes.byref(offset), count)
+        if n > 0:
+            count -= n
+        elif n == 0:
+            break  # file got shorter
+        else:
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            if err != errno.EAGAIN:
+                raise socket.error(err, os.strerror(err))
+            # sockets with a timeout are non-blocking at the OS level
+            if not select.select([], [sock], [], sock.gettimeout())[1]:
+                raise socket.timeout("timed out")
+
+class ResponseBody(object):
+    # response data, either in memory or in a file; file-backed bodies are
+    # sent with sendfile() where possible, and stay readable for requests
+    # in flight after being discarded
+    def __init__(self, data=None, filename=None):
+        self.data = data
+        self.filename = filename
+        self.file = None
+        self.mutex = threading.Lock()
+        if filename:
+            self.file = open(filename, "rb")
+            self.size = os.fstat(self.file.fileno()).st_size
+        else:
+            self.size = len(data)
+
+    def read(self, offset=0, count=None):
+        if count is None:
+            count = self.size - offset
+        if not self.file:
+            return self.data[offset : offset + count]
+        with self.mutex:
+            self.file.seek(offset)
+            return self.file.read(count)
+
+    def send(self, wfile, sock, offset, count):
+        if self.file and libc_sendfile:
+            wfile.flush()
+            return sendfile(sock, self.file.fileno(), offset, count)
+        while count > 0:
+            chunk = self.read(offset, min(count, SendChunkSize))
+            if not chunk:
+                break
+            wfile.write(chunk)
+            offset += len(chunk)
+            count -= len(chunk)
+
+    def discard(self):
+        if self.filename:
+            try:
+                os.unlink(self.filename)
+            except EnvironmentError:
+                pass
+
+class ResponseCache(object):
+    # directory for large pre-encoded responses, like the tracklist variants
+    # of each scan generation; without one, bodies are kept in memory
+    directory = None
+    temporary = False
+    counter = itertools.count(1)
+
+    @classmethod
+    def open(self, directory=None):
+        if directory:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            for name in os.listdir(directory):
+                if name.startswith("body-"):
+                    os.unlink(os.path.join(directory, name))
+        else:
+            directory = tempfile.mkdtemp(prefix="kjukebox-")
+            self.temporary = True
+        self.directory = directory
+
+    @classmethod
+    def close(self):
+        if self.temporary:
+            shutil.rmtree(self.directory, ignore_errors=True)
+        self.directory = None
+
+    @classmethod
+    def store(self, name, data):
+        if not self.directory:
+            return ResponseBody(data)
+        filename = os.path.join(self.directory, "body-%s-%d" % (name, next(self.counter)))
+        try:
+            with open(filename, "wb") as f:
+                f.write(data)
+            return ResponseBody(filename=filename)
+        except EnvironmentError, e:
+            log("WARNING: failed to write response cache file - %s" % e)
+            return ResponseBody(data)
+
 class WebServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
     pass
 
+class RateLimiter(object):
+    # per-client token buckets
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.mutex = threading.Lock()
+        self.buckets = {}
+
+    def allow(self, client):
+        if self.rate <= 0:
+            return True
+        now = time.time()
+        with self.mutex:
+            tokens, last = self.buckets.get(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            ok = tokens >= 1.0
+            self.buckets[client] = ((tokens - 1.0) if ok else tokens, now)
+            if len(self.buckets) > 1024:
+                # forget clients whose buckets have been refilled completely
+                limit = now - self.burst / self.rate
+                self.buckets = dict(b for b in self.buckets.iteritems() if b[1][1] > limit)
+            return ok
+
 def _get_etag():
     try:
         return str(int(os.path.getmtime(sys.argv[0])))
@@ -1059,16 +3943,62 @@ def _get_etag():
 class WebRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     etag = _get_etag()
     quitcmds = {}
+    ratelimit = RateLimiter(*DefaultRateLimit)
+    clients = {}  # IP address -> time of last request
+    readonly_cmds = set("tracklist playlist history export folders metrics thumb mostplayed leastplayed playsperhour duplicates debugstacks debuglocks debugprofile".split())
     server_version = "kjukebox/" + __version__
 
     def do_GET(self):
+        self._dispatch(self._handle_GET)
+
+    def do_POST(self):
+        self._dispatch(self._handle_POST)
+
+    def _dispatch(self, handler):
+        t0 = time.time()
+        self.clients[self.client_address[0]] = t0
         self._response_sent = False
         try:
             path, params = self.path.split('?', 1)
         except ValueError:
             path, params = self.path, None
         path = path.strip('/').lower()
+        try:
+            Debug.run(handler, path, params)
+        finally:
+            if (path in StaticHTMLContent) or hasattr(self, "cmd_" + path) or hasattr(self, "post_" + path):
+                endpoint = "/" + path
+            elif path in self.quitcmds:
+                endpoint = "quitcmd"
+            else:
+                endpoint = "other"
+            Metrics.observe("kjukebox_http_request_seconds", time.time() - t0, endpoint=endpoint)
+
+    @classmethod
+    def active_clients(self):
+        limit = time.time() - ListenerTimeout
+        for ip, t in self.clients.items():
+            if t < limit:
+                self.clients.pop(ip, None)
+        return len(self.clients)
 
+    def _handle_POST(self, path, params):
+        method = getattr(self, "post_" + path, None)
+        if not method:
+            return self.respond(404)
+        if not self.check_ratelimit():
+            return
+        try:
+            size = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            return self.respond(400)
+        if (size < 0) or (size > MaxBatchSize):
+            return self.respond(413)
+        method(params, self.rfile.read(size))
+        if not self._response_sent:
+            self.respond(200)
+
+    def _handle_GET(self, path, params):
         if path in StaticHTMLContent:
             if self.headers.get("If-None-Match") == self.etag:
                 return self.respond(304)
@@ -1084,13 +4014,15 @@ class WebRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
         method = getattr(self, "cmd_" + path, None)
         if method:
-            method(params)
+            if not(path in self.readonly_cmds) and not(self.check_ratelimit()):
+                return
+            result = method(params)
             if not self._response_sent:
-                self.respond(200)
+                self.respond_with_version(result)
             return
 
         try:
-            ListManager.quit(self.quitcmds[path.lower()])
+            Engine.call(ListManager.quit, self.quitcmds[path.lower()])
             return self.respond(200)
         except KeyError:
             pass
@@ -1108,41 +4040,237 @@ class WebRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             self.wfile.write(data)
         self._response_sent = True
 
+    def respond_with_body(self, ctype, body, headers={}):
+        # sends a ResponseBody, honoring requests for a single byte range
+        headers = dict(headers)
+        headers["Accept-Ranges"] = "bytes"
+        start, end, code = 0, body.size, 200
+        rng = re.match(r'bytes=(\d*)-(\d*)$', self.headers.get("Range", "").strip())
+        if rng and any(rng.groups()) and (self.headers.get("If-Range", headers.get("ETag")) == headers.get("ETag")):
+            first, last = rng.groups()
+            if first:
+                start = int(first)
+                end = min(body.size, int(last) + 1) if last else body.size
+            else:
+                start = max(0, body.size - int(last))
+            if start >= end:
+                return self.respond(416, headers={"Content-Range": "bytes */%d" % body.size})
+            code = 206
+            headers["Content-Range"] = "bytes %d-%d/%d" % (start, end - 1, body.size)
+        headers["Content-Length"] = str(end - start)
+        self.respond(code, ctype, None, headers)
+        body.send(self.wfile, self.connection, start, end - start)
+
     def respond_with_list(self, data, headers={}):
         self.respond(200, "text/plain; charset=utf-8", '\n'.join(data), headers)
 
+    def respond_with_list_body(self, name):
+        # browsers revalidate the list on each poll, which is answered with
+        # a 304 unless the list has changed
+        deflate = self.can_deflate()
+        version, etag, data = Engine.read(name + (".deflate" if deflate else ""))
+        headers = {"ETag": etag, "Cache-Control": "no-cache", "X-State-Version": str(version)}
+        if self.headers.get("If-None-Match") == etag:
+            return self.respond(304, headers=headers)
+        if deflate:
+            headers["Content-Encoding"] = "deflate"
+        self.respond(200, "text/plain; charset=utf-8", data, headers)
+
+    def respond_with_version(self, version):
+        # commands answer with the new state version, or with 409 and the
+        # current version if they had no effect
+        if version is None:
+            return self.respond(409, "text/plain", str(ListManager.state_version))
+        self.respond(200, "text/plain", str(version))
+
+    def check_ratelimit(self):
+        if self.ratelimit.allow(self.client_address[0]):
+            return True
+        Metrics.inc("kjukebox_http_ratelimited_total")
+        self.respond(429, headers={"Retry-After": "1"})
+        return False
+
     def can_deflate(self):
         return ("deflate" in self.headers.get("Accept-Encoding", ""))
 
     def cmd_tracklist(self, params):
-        etag = ListManager.scan_tag
+        etag, tracklists = Engine.read("tracklists")
         if not etag:
             return self.respond_with_list(ListManager.get_tracklist())
+        compact = (params == "compact")
+        if compact:
+            etag += "c"
         if self.headers.get("If-None-Match") == etag:
             return self.respond(304)
         headers = {"ETag": etag}
         deflate = self.can_deflate()
         if deflate: headers["Content-Encoding"] = "deflate"
-        self.respond(200, "text/plain; charset=utf-8", ListManager.get_tracklist_str(deflate), headers)
-
-    def cmd_playlist(self, params):  self.respond_with_list(ListManager.get_playlist())
-    def cmd_history(self, params):   self.respond_with_list(ListManager.get_history())
-    def cmd_add(self, params):       ListManager.add_to_back(params)
-    def cmd_insert(self, params):    ListManager.add_to_front(params)
-    def cmd_playnow(self, params):   ListManager.play_specific(params)
-    def cmd_remove(self, params):    ListManager.remove_file(params)
-    def cmd_rollback(self, params):  ListManager.rewind_to(params)
-    def cmd_prev(self, params):      ListManager.prev()
-    def cmd_next(self, params):      ListManager.next()
-    def cmd_play(self, params):      ListManager.play()
-    def cmd_stop(self, params):      ListManager.stop()
-    def cmd_rescan(self, params):    ListManager.rescan()
+        self.respond_with_body("text/plain; charset=utf-8", tracklists[(compact, deflate)], headers)
+
+    def cmd_playlist(self, params):  self.respond_with_list_body("playlist")
+    def cmd_history(self, params):   self.respond_with_list_body("history")
+    def cmd_add(self, params):       return Engine.call(ListManager.add_to_back, params)
+    def cmd_insert(self, params):    return Engine.call(ListManager.add_to_front, params)
+    def cmd_playnow(self, params):   return Engine.call(ListManager.play_specific, params)
+    def cmd_remove(self, params):    return Engine.call(ListManager.remove_file, params)
+    def cmd_rollback(self, params):  return Engine.call(ListManager.rewind_to, params)
+    def cmd_move(self, params):
+        args = dict(urlparse.parse_qsl(params or ""))
+        return Engine.call(ListManager.move, args.get("id"), args.get("pos"))
+    def cmd_prev(self, params):      return ListManager.skip(-1)
+    def cmd_next(self, params):      return ListManager.skip(+1)
+    def cmd_play(self, params):      return Engine.call(ListManager.play)
+    def cmd_stop(self, params):      return Engine.call(ListManager.stop)
+    def cmd_rescan(self, params):    return ListManager.rescan()
+    def cmd_reload(self, params):    return ListManager.state_version if Config.reload() else None
+
+    def cmd_folders(self, params):       self.respond_with_list(Engine.call(lambda folder: list(ListManager.get_folder(folder)), urllib.unquote(params or "")))
+    def cmd_addfolder(self, params):     return Engine.call(ListManager.add_folder, urllib.unquote(params or ""))
+    def cmd_shufflefolder(self, params): return Engine.call(ListManager.add_folder, urllib.unquote(params or ""), True)
+
+    def post_batch(self, params, body):
+        # one operation per line: COMMAND ID [POSITION]
+        ops = [tuple(line.split()) for line in body.splitlines() if line.strip()]
+        version, failed = Engine.call(ListManager.batch, ops)
+        self.respond_with_list([str(version)] + ['\t'.join(op) for op in failed])
+
+    def post_import(self, params, body):
+        # M3U/M3U8/PLS file to append to the playlist, or to replace it with
+        # /import?replace; answers with the new version, then the entries
+        # that could not be found
+        version, missing = Engine.call(ListManager.import_playlist, parse_playlist(body), params == "replace")
+        self.respond_with_list([str(version)] + missing)
+
+    def cmd_export(self, params):
+        # /export?playlist.m3u8, /export?history.pls etc.
+        name, sep, fmt = (params or "").lower().partition('.')
+        if not(name in ("playlist", "history")) or not(fmt in PlaylistFormats):
+            return self.respond(404)
+        files = Engine.call(ListManager.get_list_files, name)
+        self.respond(200, PlaylistFormats[fmt], None,
+                     {"Content-Disposition": 'attachment; filename="%s.%s"' % (name, fmt)})
+        chunks = format_playlist(files, fmt)
+        while True:
+            data = ''.join(itertools.islice(chunks, ExportChunkSize))
+            if not data:
+                break
+            self.wfile.write(data)
+
+    def cmd_metrics(self, params):
+        self.respond(200, "text/plain; version=0.0.4; charset=utf-8", Metrics.render())
+
+    def cmd_mostplayed(self, params):  self.respond_with_stats(params, least=False)
+    def cmd_leastplayed(self, params): self.respond_with_stats(params, least=True)
+
+    def respond_with_stats(self, params, least):
+        # /mostplayed?N, /leastplayed?N: lines of COUNT<tab>ID<tab>NAME
+        if not Database.enabled:
+            return self.respond(404)
+        try:
+            count = min(MaxStatsCount, int(params or DefaultStatsCount))
+        except ValueError:
+            return self.respond(400)
+        rows = Database.most_played(count, least)
+        files = Engine.call(ListManager.get_files_by_key, [key for key, n in rows])
+        self.respond_with_list("%d\t%s" % (n, f.fmt()) for (key, n), f in zip(rows, files) if f)
+
+    def cmd_duplicates(self, params):
+        # lines of GROUP<tab>ID<tab>NAME for each set of identical files
+        if not Deduplicator.enabled:
+            return self.respond(404)
+        self.respond_with_list("%d\t%s" % (n, f.fmt()) for n, files in enumerate(Engine.call(ListManager.get_duplicates), 1) for f in files)
+
+    def cmd_playsperhour(self, params):
+        # /playsperhour[?DAYS]: lines of HOUR<tab>COUNT, local time
+        if not Database.enabled:
+            return self.respond(404)
+        try:
+            since = (time.time() - 86400 * float(params)) if params else 0
+        except ValueError:
+            return self.respond(400)
+        self.respond_with_list("%d\t%d" % row for row in Database.plays_per_hour(since))
+
+    def check_debug(self):
+        if Debug.allow(self.client_address[0]):
+            return True
+        self.respond(404)
+        return False
+
+    def cmd_debugstacks(self, params):
+        if self.check_debug():
+            self.respond_with_list(Debug.thread_stacks())
+
+    def cmd_debuglocks(self, params):
+        if self.check_debug():
+            self.respond_with_list(Debug.lock_status())
+
+    def cmd_debugprofile(self, params):
+        # /debugprofile?seconds=N[&mode=sample|cprofile][&raw]
+        if not self.check_debug():
+            return
+        args = dict(urlparse.parse_qsl(params or "", keep_blank_values=True))
+        try:
+            seconds = max(0.0, min(MaxProfileTime, float(args.get("seconds", DefaultProfileTime))))
+        except ValueError:
+            return self.respond(400)
+        if args.get("mode", "sample") == "sample":
+            lines = Debug.sample(seconds)
+            if lines is None:
+                return self.respond(409)
+            return self.respond_with_list(lines)
+        if args.get("mode") != "cprofile":
+            return self.respond(400)
+        profiles = Debug.profile(seconds)
+        if profiles is None:
+            return self.respond(409)
+        if not profiles:
+            return self.respond(200, "text/plain", "nothing was profiled\n")
+        stats = pstats.Stats(*profiles)
+        if "raw" in args:
+            return self.respond(200, "application/octet-stream", marshal.dumps(stats.stats),
+                                {"Content-Disposition": 'attachment; filename="kjukebox.prof"'})
+        out = cStringIO.StringIO()
+        stats.stream = out
+        stats.sort_stats("cumulative").print_stats(100)
+        self.respond(200, "text/plain", out.getvalue())
+
+    def cmd_thumb(self, params):
+        # /thumb?ID[&r=N]; without an ID, just tells whether thumbnails are available
+        iid = (params or "").split('&')[0]
+        if not Thumbnailer.enabled:
+            return self.respond(404)
+        if not iid:
+            return self.respond(200)
+        f = Engine.call(ListManager.get_file, iid)
+        if not f:
+            return self.respond(404)
+        cached, pending = Thumbnailer.get(os.path.join(ListManager.root, f.path))
+        if pending:
+            return self.respond(200, "image/gif", PlaceholderGIF, {"Cache-Control": "no-store"})
+        if not cached:
+            return self.respond(404)
+        etag = os.path.basename(cached)
+        if self.headers.get("If-None-Match") == etag:
+            return self.respond(304)
+        try:
+            body = ResponseBody(filename=cached)
+        except EnvironmentError:
+            return self.respond(404)
+        self.respond_with_body("image/jpeg", body, {"ETag": etag, "Cache-Control": "max-age=%d" % ThumbnailMaxAge})
 
     def log_message(self, format, *args):
+        log_access(format % args)
+
+    def log_error(self, format, *args):
         log(format % args)
 
 ################################################################################
 
+def ratelimit(s):
+    rate, sep, burst = s.partition(':')
+    rate = float(rate)
+    return (rate, int(burst) if burst else max(1, int(2 * rate)))
+
 def quitcmd(s):
     try:
         cmd, code = map(str.strip, s.replace(':', '=').split('='))
@@ -1151,6 +4279,228 @@ def quitcmd(s):
         code = 0
     return (cmd, int(code))
 
+def setup_status_screen(args):
+    StatusScreen.live = args.live_status
+    if args.logo:
+        StatusScreen.init(logofile=args.logo)
+    else:
+        ip = get_own_ip()
+        if is_local_ip(ip):
+            StatusScreen.init()
+        else:
+            stext = "http://\0%s" % ip
+            if args.port != 80:
+                stext += "\0:%s" % args.port
+            StatusScreen.init(text=stext)
+
+def start_early(statefile, status_ready):
+    # with --autoplay: start the first saved playlist entry or, if there is
+    # none, a random file while the library is still being scanned
+    key = ListManager.peek_resume(statefile)
+    if key:
+        path = find_file_by_key(ListManager.root, key)
+    else:
+        path = pick_random_file(ListManager.root)
+    status_ready.wait()
+    return bool(path) and ListManager.play_early(path)
+
+class Startup(object):
+    # runs startup steps that don't depend on each other in background
+    # threads and keeps track of how long each step took
+    def __init__(self):
+        self.t0 = time.time()
+        self.phases = []
+
+    def record(self, name, t0):
+        self.phases.append((name, time.time() - t0))
+
+    def spawn(self, name, func, *args):
+        future = Future()
+        def run():
+            t0 = time.time()
+            result, exc_info = None, None
+            try:
+                result = func(*args)
+            except Exception:
+                exc_info = sys.exc_info()
+            self.record(name, t0)
+            future.set(result, exc_info)
+        t = threading.Thread(target=run, name="Startup")
+        t.daemon = True
+        t.start()
+        return future
+
+    def report(self):
+        log("startup took %.3f seconds (%s)" % (time.time() - self.t0, ", ".join("%s %.3f s" % p for p in self.phases)))
+
+def apply_settings(args, old=None):
+    # everything that can be changed without a restart; 'old' are the
+    # previous settings when reloading
+    Engine.call(ListManager.configure, args)
+    WebRequestHandler.quitcmds = dict(args.quitcmd or [])
+    if not(old) or (args.ratelimit != old.ratelimit):
+        WebRequestHandler.ratelimit = RateLimiter(*args.ratelimit)
+    Loudness.target = args.loudness_target
+    Debug.enabled = args.debug_endpoints
+    Debug.allowed = set(ip.strip() for ip in (args.debug_allow or "").split(',') if ip.strip())
+    Logger.level = LogLevels[args.loglevel]
+    Logger.access_rate = args.accesslog
+    if not old:
+        return
+    if (args.player != old.player) or (args.windowed != old.windowed):
+        cmdline = setup_player(args.player, fullscreen=not(args.windowed))
+        if cmdline:
+            log("switching player to '%s' for the next track" % ' '.join(cmdline))
+            ListManager.cmdline = cmdline
+        else:
+            log("ERROR: selected player %r is invalid or unavailable, keeping the old one" % args.player, True)
+    if (args.logo != old.logo) or (args.live_status != old.live_status):
+        setup_status_screen(args)
+        Engine.call(ListManager.redraw_status)
+
+class Config(object):
+    # command-line options, optionally preceded by those from a config file
+    # in the same format (options separated by whitespace or newlines, lines
+    # starting with '#' are ignored); can be reloaded while running
+    parser = None
+    argv = []
+    args = None
+    mutex = threading.Lock()
+    reload_requested = False
+    restart_only = "srcdir port statefile logfile logjson logsize logbackups playerlog database cachedir " \
+                   "transcode transcode_cmd transcode_size transcode_jobs transcode_idle thumbnails thumbnail_size " \
+                   "loudness loudness_jobs dedupe dedupe_jobs engine".split()
+
+    @staticmethod
+    def read_file(filename):
+        args = []
+        with open(filename) as f:
+            for line in f:
+                if not line.lstrip().startswith('#'):
+                    args.extend(line.split())
+        return args
+
+    @classmethod
+    def parse(self, argv):
+        self.argv = argv
+        args = self.parser.parse_args(argv)
+        if args.config:
+            try:
+                file_args = self.read_file(args.config)
+            except EnvironmentError, e:
+                self.parser.error("can not read config file - %s" % e)
+            args = self.parser.parse_args(file_args + argv)
+        self.args = args
+        return args
+
+    @classmethod
+    def reload(self):
+        with self.mutex:
+            old = self.args
+            try:
+                args = self.parse(self.argv)
+            except SystemExit:  # argparse reports errors this way
+                self.args = old
+                log("ERROR: invalid configuration, keeping the old one", True)
+                return False
+            for name in self.restart_only:
+                if getattr(args, name) != getattr(old, name):
+                    log("WARNING: changing option '%s' requires a restart" % name)
+            apply_settings(args, old)
+            log("configuration reloaded")
+            return True
+
+class Handover(object):
+    # hot restart, e.g. after an upgrade: the process replaces itself with
+    # a fresh instance of the program, which takes over the listening
+    # socket, the in-memory state and the player that is still running
+    supported = bool(fcntl) and hasattr(os, "execv")
+    requested = False
+
+    @staticmethod
+    def _set_cloexec(fd, cloexec=True):
+        flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+        fcntl.fcntl(fd, fcntl.F_SETFD, (flags | fcntl.FD_CLOEXEC) if cloexec else (flags & ~fcntl.FD_CLOEXEC))
+
+    @classmethod
+    def _open_fds(self):
+        try:
+            return map(int, os.listdir("/proc/self/fd"))
+        except (EnvironmentError, ValueError):
+            return xrange(3, os.sysconf("SC_OPEN_MAX"))
+
+    @classmethod
+    def load(self):
+        # returns the predecessor's state if we've been started by execute()
+        filename = os.environ.pop(HandoverEnv, None)
+        if not filename:
+            return None
+        try:
+            with open(filename, "rb") as f:
+                snap = marshal.load(f)
+            os.unlink(filename)
+        except (EnvironmentError, EOFError, ValueError, TypeError), e:
+            print >>sys.stderr, "WARNING: failed to read hand-over state, starting afresh -", e
+            return None
+        if snap.get("format") != HandoverFormat:
+            print >>sys.stderr, "WARNING: incompatible hand-over state, starting afresh"
+            return None
+        return snap
+
+    @staticmethod
+    def adopt_socket(httpd, fd):
+        httpd.socket = socket.fromfd(fd, httpd.address_family, httpd.socket_type)
+        os.close(fd)
+        httpd.server_address = httpd.socket.getsockname()
+        httpd.server_name, httpd.server_port = httpd.server_address[:2]
+
+    @classmethod
+    def execute(self, httpd):
+        # only returns if the hand-over could not be started
+        argv = [sys.executable, os.path.abspath(sys.argv[0])] + Config.argv
+        if not(os.access(argv[0], os.X_OK) and os.path.isfile(argv[1])):
+            log("ERROR: can not restart, '%s' or '%s' is missing" % tuple(argv[:2]), True)
+            return
+        log("handing over to a new process")
+        httpd.shutdown()  # pending connections wait in the socket's backlog
+        with ListManager.mutex:
+            ListManager._locked_save()
+            snap = ListManager._locked_snapshot()
+            snap["socket"] = httpd.socket.fileno()
+            snap["port"] = httpd.server_address[1]
+            try:
+                fd, filename = tempfile.mkstemp(prefix="kjukebox-handover-")
+                with os.fdopen(fd, "wb") as f:
+                    marshal.dump(snap, f)
+            except (EnvironmentError, ValueError), e:
+                log("ERROR: failed to save hand-over state - %s" % e, True)
+                thread = threading.Thread(target=httpd.serve_forever)
+                thread.daemon = True
+                thread.start()
+                return
+            Database.close()
+            ResponseCache.close()
+            log("restarting: %s" % ' '.join(argv))
+            Logger.close()
+            if ListManager.player_log:
+                ListManager.player_log.close()
+            # only the socket and the player's output pipe survive the exec
+            keep = (snap["socket"], snap["player_stdout"])
+            for fd in self._open_fds():
+                if fd > 2:
+                    try:
+                        self._set_cloexec(fd, not(fd in keep))
+                    except EnvironmentError:
+                        pass
+            os.environ[HandoverEnv] = filename
+            sys.stdout.flush()
+            try:
+                os.execv(argv[0], argv)
+            except OSError, e:
+                print >>sys.stderr, "FATAL: failed to restart -", e
+                ListManager._locked_stop()
+                os._exit(1)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         usage="%(prog)s [OPTIONS...] [SRCDIR]",
@@ -1159,6 +4509,8 @@ if __name__ == "__main__":
     parser.add_argument("srcdir", metavar="SRCDIR", nargs='?', default='.',
                         help="input directory")
     parser.add_argument("-V", "--version", action='version', version=__version__)
+    parser.add_argument("-c", "--config", metavar="FILE",
+                        help="read additional options from FILE; it is read again on SIGHUP or the /reload web request, applying most changes immediately")
     parser.add_argument("-p", "--port", metavar="N", type=int, default=DefaultPort,
                         help="web interface port [default: %(default)s]")
     parser.add_argument("-x", "--player", metavar="EXE",
@@ -1173,33 +4525,160 @@ if __name__ == "__main__":
                         help="automatically rescan the input directory at every played track")
     parser.add_argument("-r", "--autoplay", action='store_true',
                         help="start playback immediately on initialization")
+    parser.add_argument("--scanthreads", metavar="N", type=int, default=DefaultScanThreads,
+                        help="scan the input directory with N parallel threads, useful for network filesystems (0 = sequential) [default: %(default)s]")
+    parser.add_argument("-k", "--lookahead", metavar="N", type=int, default=DefaultLookahead,
+                        help="number of automatically selected tracks to queue in advance [default: %(default)s]")
+    parser.add_argument("-g", "--spread", metavar="N", type=int, default=DefaultFolderSpread,
+                        help="avoid playing automatically selected tracks from the same top-level folder as the last N tracks [default: %(default)s]")
     parser.add_argument("-d", "--maxhist", metavar="N", type=int, default=DefaultHistoryDepth,
                         help="only preserve history for the last N tracks [default: %(default)s]")
     parser.add_argument("-t", "--logo", metavar="FILE",
                         help="display a text file instead of the IP address on the info screen ('-' to disable info screen logo completely)")
+    parser.add_argument("--live-status", action='store_true',
+                        help="show the time and the number of web interface users on the info screen, updated every second")
     parser.add_argument("-l", "--logfile", metavar="FILE",
                         help="produce debug logfile")
+    parser.add_argument("--loglevel", metavar="LEVEL", choices=sorted(LogLevels, key=LogLevels.get), default="info",
+                        help="minimum level of messages to write into the logfile (%(choices)s) [default: %(default)s]")
+    parser.add_argument("--logjson", action='store_true',
+                        help="write the logfile in JSON lines format")
+    parser.add_argument("--logsize", metavar="BYTES", type=int, default=DefaultLogMaxSize,
+                        help="rotate logfiles when they grow beyond this size, 0 = never [default: %(default)s]")
+    parser.add_argument("--logbackups", metavar="N", type=int, default=DefaultLogBackups,
+                        help="number of rotated logfiles to keep [default: %(default)s]")
+    parser.add_argument("--accesslog", metavar="RATE", type=float, default=1.0,
+                        help="fraction of web requests to log (0 = only at debug level, 1 = all) [default: %(default)s]")
+    parser.add_argument("--playerlog", metavar="FILE",
+                        help="file to write player output to [default: logfile name plus '.player']")
+    parser.add_argument("--ratelimit", metavar="RATE[:BURST]", type=ratelimit, default=DefaultRateLimit,
+                        help="limit web commands per client to RATE per second with bursts of BURST, 0 = unlimited [default: %s:%s]" % DefaultRateLimit)
+    parser.add_argument("--coalesce", metavar="SECONDS", type=float, default=DefaultCoalesceWindow,
+                        help="merge next/previous commands arriving within this time into a single skip, 0 = off [default: %(default)s]")
+    parser.add_argument("--transcode", metavar="DIR",
+                        help="convert files the player can't decode well (not H.264 up to 1080p30) in the background into cache directory DIR")
+    parser.add_argument("--transcode-cmd", metavar="CMD", default=DefaultTranscodeCmd,
+                        help="transcoder command line, '$' = input file, '@' = output file [default: ffmpeg to H.264/AAC]")
+    parser.add_argument("--transcode-size", metavar="MB", type=int, default=DefaultTranscodeCacheSize,
+                        help="maximum size of the transcode cache in MiB [default: %(default)s]")
+    parser.add_argument("--transcode-jobs", metavar="N", type=int, default=DefaultTranscodeJobs,
+                        help="number of concurrent transcoder processes [default: %(default)s]")
+    parser.add_argument("--transcode-idle", action='store_true',
+                        help="only transcode while no track is playing")
+    parser.add_argument("--transcode-only", action='store_true',
+                        help="just fill the transcode cache for SRCDIR and exit, e.g. on a more powerful machine; the cache can be used wherever SRCDIR is mounted, as long as the files' modification times are kept when copying them (e.g. rsync -t)")
+    parser.add_argument("--thumbnails", metavar="DIR",
+                        help="show preview pictures in the web interface, extracted with ffmpeg into cache directory DIR")
+    parser.add_argument("--thumbnail-size", metavar="MB", type=int, default=DefaultThumbnailCacheSize,
+                        help="maximum size of the thumbnail cache in MiB [default: %(default)s]")
+    parser.add_argument("--import-playlist", metavar="FILE",
+                        help="append the tracks from M3U/M3U8/PLS file FILE to the playlist on startup")
+    parser.add_argument("--loudness", metavar="FILE",
+                        help="measure the loudness of all files with ffmpeg, caching the results in FILE, and make the player (MPV, VLC, MPlayer or OMXPlayer) play them at the same level")
+    parser.add_argument("--loudness-target", metavar="LUFS", type=float, default=DefaultLoudnessTarget,
+                        help="loudness level to adjust all tracks to [default: %(default)s]")
+    parser.add_argument("--loudness-jobs", metavar="N", type=int, default=DefaultLoudnessJobs,
+                        help="number of concurrent loudness measurements [default: %(default)s]")
+    parser.add_argument("--dedupe", metavar="FILE",
+                        help="detect files with identical content and play them as one track, caching file fingerprints in FILE")
+    parser.add_argument("--dedupe-jobs", metavar="N", type=int, default=DefaultDedupeJobs,
+                        help="number of processes for fingerprinting files [default: %(default)s]")
+    parser.add_argument("--database", metavar="FILE",
+                        help="keep library, play events, play counts and playlist in SQLite database FILE instead of the state file; an existing state file is imported on first use")
+    parser.add_argument("--import-state", metavar="FILE",
+                        help="replace history, playlist and play counts in the database with the contents of state file FILE and exit")
+    parser.add_argument("--export-state", metavar="FILE",
+                        help="write history, playlist and play counts from the database into state file FILE and exit")
+    parser.add_argument("--cachedir", metavar="DIR",
+                        help="directory for pre-encoded web responses, 'none' = keep them in memory [default: a temporary directory]")
+    parser.add_argument("--engine", action='store_true',
+                        help="run all playlist operations in one dedicated thread and answer the web interface's list requests from snapshots, instead of letting all threads compete for one lock")
+    parser.add_argument("--debug-endpoints", action='store_true',
+                        help="enable the /debugstacks, /debuglocks and /debugprofile web requests for local clients")
+    parser.add_argument("--debug-allow", metavar="IP[,IP...]",
+                        help="also allow these clients to use the debug requests")
     parser.add_argument("-q", "--quitcmd", metavar="CMD[=EXITCODE]", type=quitcmd, action='append',
                         help="define web requests that cause the program to quit")
-    args = parser.parse_args()
+    Config.parser = parser
+    args = Config.parse(sys.argv[1:])
+    handover = Handover.load()
 
     ListManager.set_root(args.srcdir)
-    ListManager.autoscan = args.autoscan
-    ListManager.autosave = args.autosave
-    ListManager.maxhist = args.maxhist
-    WebRequestHandler.quitcmds = dict(args.quitcmd or [])
-
+    apply_settings(args)
+    Logger.json = args.logjson
     if args.logfile:
         try:
-            logfile = open(args.logfile, "a")
-            print >>logfile
-            print >>logfile, 79 * '='
+            Logger.open(args.logfile, args.logsize, args.logbackups)
+            log_raw("")
+            log_raw(79 * '=')
             log("kjukebox %s starting" % __version__)
-            print >>logfile, 79 * '='
-            logfile.flush()
+            log_raw(79 * '=')
         except EnvironmentError, e:
             print >>sys.stderr, "ERROR: failed to open log file -", e
             sys.exit(1)
+    if args.playerlog or args.logfile:
+        try:
+            ListManager.player_log = RotatingFile(args.playerlog or (args.logfile + ".player"), args.logsize, args.logbackups)
+        except EnvironmentError, e:
+            print >>sys.stderr, "ERROR: failed to open player log file -", e
+            sys.exit(1)
+
+    if args.transcode:
+        Transcoder.cmdline = args.transcode_cmd.split()
+        Transcoder.maxsize = args.transcode_size * 1024 * 1024
+        Transcoder.jobs = args.transcode_jobs
+        Transcoder.idle_only = args.transcode_idle
+        try:
+            Transcoder.start(args.transcode)
+        except EnvironmentError, e:
+            print >>sys.stderr, "ERROR: failed to set up transcode cache -", e
+            sys.exit(1)
+        if args.transcode_only:
+            print "scanning for files ..."
+            ListManager.rescan()
+            print "transcoding ..."
+            Transcoder.stop()
+            print "done."
+            Logger.close()
+            sys.exit(0)
+    elif args.transcode_only:
+        parser.error("--transcode-only requires --transcode")
+
+    if args.database:
+        try:
+            Database.open(args.database)
+        except EnvironmentError, e:
+            print >>sys.stderr, "ERROR: failed to open database -", e
+            sys.exit(1)
+        if args.import_state or args.export_state:
+            print "scanning for files ..."
+            ListManager.rescan()
+            if args.import_state:
+                ListManager.import_state(args.import_state)
+            else:
+                ListManager.load_state()
+                ListManager.export_state(args.export_state)
+            Database.close()
+            print "done."
+            Logger.close()
+            sys.exit(0)
+    elif args.import_state or args.export_state:
+        parser.error("--import-state and --export-state require --database")
+
+    if args.thumbnails:
+        try:
+            Thumbnailer.start(args.thumbnails, args.thumbnail_size * 1024 * 1024)
+        except EnvironmentError, e:
+            print >>sys.stderr, "ERROR: failed to set up thumbnail cache -", e
+            sys.exit(1)
+
+    if args.loudness:
+        Loudness.jobs = args.loudness_jobs
+        Loudness.start(args.loudness)
+
+    if args.dedupe:
+        Deduplicator.jobs = args.dedupe_jobs
+        Deduplicator.start(args.dedupe)
 
     ListManager.cmdline = setup_player(args.player, fullscreen=not(args.windowed))
     if not ListManager.cmdline:
@@ -1208,53 +4687,110 @@ if __name__ == "__main__":
         else:
             parser.error("could not find a player, use --player option to specify one manually")
 
+    startup = Startup()
+    # finding out the IP address for the status screen may take a while
+    status_ready = startup.spawn("status screen", setup_status_screen, args)
+
     try:
         print "starting web server ..."
-        httpd = WebServer(('', args.port), WebRequestHandler)
+        t0 = time.time()
+        if handover and (handover["port"] == args.port):
+            httpd = WebServer(('', args.port), WebRequestHandler, bind_and_activate=False)
+            Handover.adopt_socket(httpd, handover["socket"])
+        else:
+            if handover:
+                os.close(handover["socket"])
+            httpd = WebServer(('', args.port), WebRequestHandler)
         httpd_thread = threading.Thread(target=httpd.serve_forever)
         httpd_thread.daemon = True
         mod_gzip()
         httpd_thread.start()
+        startup.record("web server", t0)
     except EnvironmentError, e:
         log("FATAL: can not start web server - %s" % e, True)
         sys.exit(1)
 
     print "server started at port", args.port
-    if args.logo:
-        StatusScreen.init(logofile=args.logo)
-    else:
-        ip = get_own_ip()
-        if is_local_ip(ip):
-            StatusScreen.init()
-        else:
-            stext = "http://\0%s" % get_own_ip()
-            if args.port != 80:
-                stext += "\0:%s" % args.port
-            StatusScreen.init(text=stext)
 
-    try:
-        print "scanning for files ..."
-        ListManager.rescan()
-        ListManager.load_state(args.statefile)
-        print "initial scan finished,", len(ListManager.files), "file(s) found."
+    if (args.cachedir or "").lower() != "none":
+        try:
+            ResponseCache.open(args.cachedir)
+        except EnvironmentError, e:
+            log("WARNING: failed to set up response cache directory, keeping responses in memory - %s" % e, True)
+
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, lambda signum, frame: setattr(Config, "reload_requested", True))
+    if Handover.supported and hasattr(signal, "SIGUSR2"):
+        signal.signal(signal.SIGUSR2, lambda signum, frame: setattr(Handover, "requested", True))
 
-        if args.autoplay:
-            ListManager.play()
+    try:
+        if handover:
+            print "taking over from the previous process ..."
+            t0 = time.time()
+            ListManager.statefile = args.statefile
+            ListManager.restore(handover)
+            startup.record("hand-over", t0)
+            print "hand-over finished,", len(ListManager.files), "file(s) in library."
+            status_ready.wait()
+            ListManager.redraw_status()
         else:
-            StatusScreen.update()
+            print "scanning for files ..."
+            early = startup.spawn("early start", start_early, args.statefile, status_ready) if args.autoplay else None
+            t0 = time.time()
+            ListManager.rescan()
+            startup.record("scan", t0)
+            t0 = time.time()
+            ListManager.load_state(args.statefile)
+            startup.record("state", t0)
+            status_ready.wait()
+            playing = early and early.wait()
+            msg = "initial scan finished, %d file(s) found." % len(ListManager.files)
+            if playing:
+                log(msg)  # don't disturb the status screen
+            else:
+                print msg
+            if args.import_playlist:
+                try:
+                    with open(args.import_playlist, "rb") as f:
+                        paths = parse_playlist(f.read(), os.path.dirname(os.path.abspath(args.import_playlist)))
+                    version, missing = ListManager.import_playlist(paths)
+                    log("imported %d of %d track(s) from '%s'" % (len(paths) - len(missing), len(paths), args.import_playlist))
+                    for path in missing:
+                        log("WARNING: playlist entry not found: %s" % path, True)
+                except EnvironmentError, e:
+                    log("ERROR: failed to import playlist - %s" % e, True)
+            if args.autoplay:
+                if not playing:
+                    ListManager.play()
+            else:
+                StatusScreen.update()
+        startup.report()
+        if args.engine:
+            Engine.start()
 
         while ListManager.retcode is None:
             time.sleep(PollInterval)
-            ListManager.tick()
+            if Config.reload_requested:
+                Config.reload_requested = False
+                Config.reload()
+            if Handover.requested:
+                Handover.requested = False
+                Handover.execute(httpd)
+            Debug.run(Engine.call, ListManager.tick)
+            StatusScreen.tick()
     except KeyboardInterrupt:
         print " -- aborted by user, shutting down."
 
     log("kjukebox exiting")
+    Engine.stop()
     ListManager.stop()
     ListManager.save_state(sort=True)
+    Database.close()
     httpd.shutdown()
     httpd.server_close()
+    ResponseCache.close()
     log("kjukebox exited")
-    if logfile:
-        logfile.close()
+    Logger.close()
+    if ListManager.player_log:
+        ListManager.player_log.close()
     sys.exit(ListManager.retcode or 0)
@@ -0,0 +1,373 @@
+#!/usr/bin/env python2
+"""
+Benchmark and simulation harness for the kjukebox ListManager engine.
+
+Builds synthetic media libraries of various sizes (preferably on a tmpfs),
+runs the engine against a fake player executable and measures the cost of
+the core operations: initial scan, state loading, automatic playlist refill,
+web command latency under concurrent clients, and state saving.
+The results are written as a JSON report so that runs of different releases
+can be compared automatically.
+"""
+import sys, os, time, json, argparse, random, shutil, tempfile, threading, platform, collections
+import httplib
+
+import kjukebox
+from kjukebox import ListManager, StatusScreen, WebServer, WebRequestHandler, Engine
+
+DefaultSizes = "1000,10000,100000"
+FilesPerDir = 20
+FakePlayer = """#!/bin/sh
+exec sleep 86400
+"""
+
+################################################################################
+
+def make_tmpdir(base=None):
+    if not base:
+        base = "/dev/shm" if os.access("/dev/shm", os.W_OK) else None
+    return tempfile.mkdtemp(prefix="kjukebox_bench_", dir=base)
+
+def build_library(root, n_files):
+    n_dirs = max(1, (n_files + FilesPerDir - 1) // FilesPerDir)
+    fanout = max(1, int(n_dirs ** 0.5 + 0.5))
+    exts = ["mp4", "mkv", "mp3", "webm"]
+    made = 0
+    d = 0
+    while made < n_files:
+        path = os.path.join(root, "artist%04d" % (d // fanout), "album%04d" % (d % fanout))
+        os.makedirs(path)
+        for i in xrange(min(FilesPerDir, n_files - made)):
+            open(os.path.join(path, "%02d - track number %d.%s" % (i, made, exts[made % len(exts)])), "w").close()
+            made += 1
+        # some noise that the scanner has to skip
+        open(os.path.join(path, "cover.jpg"), "w").close()
+        d += 1
+
+def make_fake_player(tmpdir):
+    path = os.path.join(tmpdir, "mpv")
+    with open(path, "w") as f:
+        f.write(FakePlayer)
+    os.chmod(path, 0755)
+    return [path, "--really-quiet", "$"]
+
+def reset_engine():
+    ListManager.files = []
+    ListManager.keys = []
+    ListManager.by_iid = {}
+    ListManager.folders = {}
+    ListManager.folder_names = []
+    ListManager.current = None
+    ListManager.playlist = kjukebox.IndexedList()
+    ListManager.history = []
+    ListManager.playcounts.clear()
+    ListManager.is_auto_playlist = False
+    ListManager.running = False
+    ListManager.player = None
+    ListManager.scan_tag = None
+    ListManager.tracklists = {}
+    ListManager.first_in_session = True
+
+class NullOutput(object):
+    encoding = "utf-8"
+    def write(self, data): pass
+    def flush(self): pass
+
+def quiet_status_screen():
+    StatusScreen.width, StatusScreen.height = 79, 23
+    StatusScreen.encoding = "utf-8"
+    StatusScreen.inter_lines, StatusScreen.pre_gap, StatusScreen.post_gap = [], [], [""]
+    StatusScreen.shown = StatusScreen.frame = StatusScreen.frame_key = None
+
+def slow_filesystem(delay):
+    # add a fixed latency to every directory listing, like a network mount
+    def slowed(func):
+        def wrapper(*args, **kwargs):
+            time.sleep(delay)
+            return func(*args, **kwargs)
+        return wrapper
+    saved = (os.listdir, kjukebox.scandir)
+    os.listdir = slowed(os.listdir)
+    if kjukebox.scandir:
+        kjukebox.scandir = slowed(kjukebox.scandir)
+    return saved
+
+def restore_filesystem(saved):
+    os.listdir, kjukebox.scandir = saved
+
+def bench_slow_scan(delay, threads):
+    res = {"delay": delay, "threads": threads}
+    saved = slow_filesystem(delay)
+    try:
+        for key, n in (("sequential_seconds", 0), ("parallel_seconds", threads)):
+            ListManager.files = []
+            ListManager.scan_threads = n
+            res[key] = timed(ListManager.rescan)
+    finally:
+        restore_filesystem(saved)
+        ListManager.scan_threads = 0
+    res["speedup"] = res["sequential_seconds"] / res["parallel_seconds"] if res["parallel_seconds"] else 0.0
+    return res
+
+def timed(func, *args, **kwargs):
+    t0 = time.time()
+    func(*args, **kwargs)
+    return time.time() - t0
+
+def percentiles(samples):
+    if not samples:
+        return {}
+    samples = sorted(samples)
+    pick = lambda p: samples[min(len(samples) - 1, int(p * len(samples)))]
+    return {
+        "count": len(samples),
+        "mean": sum(samples) / len(samples),
+        "p50": pick(0.50),
+        "p95": pick(0.95),
+        "p99": pick(0.99),
+        "max": samples[-1],
+    }
+
+def write_state_file(filename, n_hist=250, n_playlist=1000):
+    keys = [f.key for f in ListManager.files]
+    with open(filename, "w") as f:
+        f.write("# synthetic benchmark state\n")
+        for k in random.sample(keys, min(n_hist, len(keys))):
+            f.write("-%s\n" % k)
+        for k in random.sample(keys, min(n_playlist, len(keys))):
+            f.write("+%s\n" % k)
+        for k in keys:
+            f.write("=%d*%s\n" % (random.randint(0, 20), k))
+
+################################################################################
+
+def bench_refill(rounds):
+    samples = []
+    for i in xrange(rounds):
+        with ListManager.mutex:
+            ListManager.playlist = kjukebox.IndexedList()
+            t0 = time.time()
+            ListManager._locked_refill()
+            samples.append(time.time() - t0)
+    return percentiles(samples)
+
+def parse_flat(data):
+    return [line.split('\t', 1) for line in data.split('\n') if line]
+
+def parse_compact(data):
+    # mirrors populateList() in script.js
+    items = []
+    d = u''
+    for line in data.decode('utf-8').split(u'\n'):
+        iid, sep, text = line.partition(u'\t')
+        if iid.startswith(u'/'):
+            d = d[:int(iid[1:])] + text
+        elif d:
+            items.append((iid, d + kjukebox.MediaFile.label_sep + text))
+        else:
+            items.append((iid, text))
+    return items
+
+def bench_tracklist():
+    res = {}
+    for name, compact in (("flat", False), ("compact", True)):
+        plain = ListManager.get_tracklist_str(False, compact)
+        res[name] = {
+            "bytes": len(plain),
+            "deflated_bytes": len(ListManager.get_tracklist_str(True, compact)),
+            "parse_seconds": timed(parse_compact if compact else parse_flat, plain),
+        }
+    return res
+
+def bench_web(clients, requests_per_client, rescans=False):
+    httpd = WebServer(('127.0.0.1', 0), WebRequestHandler)
+    port = httpd.server_address[1]
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    ids = [str(f.iid) for f in random.sample(ListManager.files, min(1000, len(ListManager.files)))]
+    commands = ["/playlist", "/history", "/add?%s", "/add?%s", "/insert?%s", "/remove?%s", "/next"]
+    latencies = collections.defaultdict(list)
+    errors = [0]
+
+    def client():
+        conn = httplib.HTTPConnection("127.0.0.1", port, timeout=30)
+        for i in xrange(requests_per_client):
+            cmd = random.choice(commands)
+            if "%s" in cmd:
+                cmd = cmd % random.choice(ids)
+            t0 = time.time()
+            try:
+                conn.request("GET", cmd)
+                res = conn.getresponse()
+                res.read()
+                if not(res.status in (200, 409)):  # 409 = command had no effect
+                    errors[0] += 1
+            except Exception:
+                errors[0] += 1
+                conn = httplib.HTTPConnection("127.0.0.1", port, timeout=30)
+                continue
+            latencies[cmd.split('?')[0]].append(time.time() - t0)
+        conn.close()
+
+    finished = threading.Event()
+    def rescanner():
+        # keeps a slow command running, like a rescan of a network mount
+        conn = httplib.HTTPConnection("127.0.0.1", port, timeout=60)
+        while not finished.is_set():
+            t0 = time.time()
+            conn.request("GET", "/rescan")
+            conn.getresponse().read()
+            latencies["/rescan"].append(time.time() - t0)
+        conn.close()
+
+    t0 = time.time()
+    threads = [threading.Thread(target=client) for i in xrange(clients)]
+    if rescans:
+        slow = threading.Thread(target=rescanner)
+        slow.start()
+    for t in threads: t.start()
+    for t in threads: t.join()
+    wall = time.time() - t0
+    finished.set()
+    if rescans:
+        slow.join()
+    rescan_latencies = latencies.pop("/rescan", [])
+    httpd.shutdown()
+    httpd.server_close()
+    ListManager.stop()
+
+    total = sum(len(v) for v in latencies.itervalues())
+    result = {
+        "clients": clients,
+        "requests": total,
+        "errors": errors[0],
+        "throughput": total / wall if wall else 0.0,
+        "all": percentiles(sum(latencies.values(), [])),
+    }
+    result["by_endpoint"] = dict((k, percentiles(v)) for k, v in latencies.iteritems())
+    if rescans:
+        result["rescans"] = percentiles(rescan_latencies)
+    return result
+
+def bench_engine(clients, requests_per_client, delay):
+    # the same web load with the global lock and with the engine thread,
+    # while one more client keeps the engine busy with slow rescans
+    res = {"delay": delay}
+    saved = slow_filesystem(delay)
+    try:
+        for mode in ("lock", "engine"):
+            if mode == "engine":
+                Engine.start()
+            try:
+                res[mode] = bench_web(clients, requests_per_client, rescans=True)
+            finally:
+                Engine.stop()
+    finally:
+        restore_filesystem(saved)
+    lock, engine = res["lock"], res["engine"]
+    res["throughput_ratio"] = engine["throughput"] / lock["throughput"] if lock["throughput"] else 0.0
+    for ep in ("/playlist", "/history"):
+        if (ep in lock["by_endpoint"]) and (ep in engine["by_endpoint"]):
+            res[ep.strip('/') + "_p99_ratio"] = engine["by_endpoint"][ep]["p99"] / lock["by_endpoint"][ep]["p99"]
+    return res
+
+def run_size(tmpdir, n_files, args):
+    res = {"files": n_files}
+    lib = os.path.join(tmpdir, "lib%d" % n_files)
+    os.makedirs(lib)
+    res["build_seconds"] = timed(build_library, lib, n_files)
+
+    reset_engine()
+    ListManager.set_root(lib)
+    res["scan_seconds"] = timed(ListManager.rescan)
+    res["rescan_unchanged_seconds"] = timed(ListManager.rescan)
+    res["files_found"] = len(ListManager.files)
+    res["tracklist"] = bench_tracklist()
+    if args.scan_threads > 1:
+        ListManager.files = []
+        ListManager.scan_threads = args.scan_threads
+        res["scan_parallel_seconds"] = timed(ListManager.rescan)
+        ListManager.scan_threads = 0
+    if args.scan_delay > 0:
+        res["slow_scan"] = bench_slow_scan(args.scan_delay / 1000.0, max(2, args.scan_threads))
+
+    statefile = os.path.join(tmpdir, "state%d" % n_files)
+    write_state_file(statefile)
+    res["load_state_seconds"] = timed(ListManager.load_state, statefile)
+    res["refill"] = bench_refill(args.refill_rounds)
+    res["save_state_seconds"] = timed(ListManager.save_state)
+    res["save_state_unsorted_seconds"] = timed(ListManager.save_state, sort=False)
+    if args.clients:
+        res["web"] = bench_web(args.clients, args.requests)
+        if args.engine_stress:
+            res["engine_stress"] = bench_engine(args.clients, args.requests, (args.scan_delay or 2.0) / 1000.0)
+
+    if not args.keep:
+        shutil.rmtree(lib, ignore_errors=True)
+    return res
+
+################################################################################
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", "--sizes", metavar="N[,N...]", default=DefaultSizes,
+                        help="comma-separated list of library sizes to test [default: %(default)s]")
+    parser.add_argument("-t", "--tmpdir", metavar="DIR",
+                        help="directory to build the synthetic libraries in [default: /dev/shm if available]")
+    parser.add_argument("-c", "--clients", metavar="N", type=int, default=8,
+                        help="number of concurrent web clients, 0 to skip the web benchmark [default: %(default)s]")
+    parser.add_argument("-r", "--requests", metavar="N", type=int, default=200,
+                        help="number of requests per web client [default: %(default)s]")
+    parser.add_argument("--scan-threads", metavar="N", type=int, default=8,
+                        help="number of threads for the parallel scan benchmark, 0 to skip it [default: %(default)s]")
+    parser.add_argument("--scan-delay", metavar="MS", type=float, default=0.0,
+                        help="also compare sequential and parallel scans with this artificial per-directory latency [default: off]")
+    parser.add_argument("--engine-stress", action='store_true',
+                        help="also compare the global lock with the engine thread (--engine) under web load plus slow rescans, using --scan-delay or 2 ms per directory")
+    parser.add_argument("--refill-rounds", metavar="N", type=int, default=50,
+                        help="number of automatic playlist refills to time [default: %(default)s]")
+    parser.add_argument("-s", "--seed", metavar="N", type=int, default=1,
+                        help="random seed [default: %(default)s]")
+    parser.add_argument("-o", "--output", metavar="FILE",
+                        help="write JSON report into FILE instead of stdout")
+    parser.add_argument("-k", "--keep", action='store_true',
+                        help="keep the synthetic libraries after the run")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    tmpdir = make_tmpdir(args.tmpdir)
+    report = {
+        "kjukebox_version": kjukebox.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "tmpdir": tmpdir,
+        "started": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "results": [],
+    }
+
+    # keep the announcement screen and request logs out of the report
+    real_stdout = sys.stdout
+    sys.stdout = NullOutput()
+    quiet_status_screen()
+    WebRequestHandler.log_message = lambda self, *args: None
+    # all simulated clients share one address
+    WebRequestHandler.ratelimit = kjukebox.RateLimiter(0, 0)
+    ListManager.cmdline = make_fake_player(tmpdir)
+    try:
+        for n in [int(x) for x in args.sizes.split(',') if x.strip()]:
+            print >>sys.stderr, "benchmarking %d files ..." % n
+            report["results"].append(run_size(tmpdir, n, args))
+    finally:
+        sys.stdout = real_stdout
+        if not args.keep:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(data + "\n")
+    else:
+        print data
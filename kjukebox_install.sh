@@ -256,6 +256,10 @@ else
 
 # Other options (host name, Samba options) can't be configured in this file;
 # please re-run kjukebox_install.sh to change these options.
+
+# Most changes to this file can be applied without restarting the jukebox by
+# opening http://<IP_address>/reload; only the port, state file, log file,
+# the player log and the cache options need a restart.
 EOF
     chown jukebox:jukebox /srv/jukebox/config/config.txt 2>/dev/null || true
 fi
@@ -300,9 +304,8 @@ echo "           ---------------------"
 echo
 echo
 
-options="\$(tr -d '\r' </srv/jukebox/config/config.txt | sed 's:^#.*::')"
 set -x
-kjukebox \$options /srv/jukebox/content
+kjukebox --config /srv/jukebox/config/config.txt /srv/jukebox/content
 code=\$?
 set +x
 [ \$code == 99 ] && sudo shutdown -P now